@@ -17,6 +17,14 @@ def flags_to_set(for_branches):
     return dict([(x, 'fixed') for x in fb])
 
 
+def rule_fields():
+    """Return the bug fields that fixed_on_branches and needed_on_branches
+    look at, ready to be asked for in a search"""
+    fields = ['id', 'summary', 'attachments', c.read_value('rules.blocking_flag')]
+    fields.extend(c.read_value('rules.status_flags').values())
+    return ','.join(sorted(set(fields)))
+
+
 def fixed_on_branches(bug):
     """Take a bug dictionary and use the bugzilla flags to determine
     which branches the bug is fixed or verifed on.  This does not
@@ -5,9 +5,13 @@ except ImportError:
 
 import time
 import os
+import threading
 
 pickle_file = '.bugs.pcl'
 
+# Bugs are fetched and stored by several threads at once
+_lock = threading.RLock()
+
 def too_old(db):
     cur = time.gmtime()
     for i in range(0, 3):
@@ -38,26 +42,33 @@ def init():
         bug_db = db_create()
 
 def store(bug):
-    if not 'bug_db' in globals():
-        init()
+    store_many([bug])
+
+def store_many(bugs):
+    """Add bugs to the database and write it out once"""
+    with _lock:
+        if not 'bug_db' in globals():
+            init()
 
-    bug_db['bugs'][int(bug['id'])] = bug
-    with open(pickle_file, 'w+') as f:
-        pickle.dump(bug_db, f)
-        f.flush()
+        for bug in bugs:
+            bug_db['bugs'][int(bug['id'])] = bug
+        with open(pickle_file, 'w+') as f:
+            pickle.dump(bug_db, f)
+            f.flush()
 
 def load(bug_id):
-    if not 'bug_db' in globals():
-        init()
-    if not bug_db['bugs'].has_key(int(bug_id)):
-        return None
-    return bug_db['bugs'][int(bug_id)]
+    with _lock:
+        if not 'bug_db' in globals():
+            init()
+        if not bug_db['bugs'].has_key(int(bug_id)):
+            return None
+        return bug_db['bugs'][int(bug_id)]
 
 def last_mod(bug_id):
-    if not 'bug_db' in globals():
-        return None
-    if bug_db['bugs'].has_key(bug_id):
-        return bug_db['bugs'][bug_id]['last_change_time']
-    else:
-        return None
-
+    with _lock:
+        if not 'bug_db' in globals():
+            return None
+        if bug_db['bugs'].has_key(bug_id):
+            return bug_db['bugs'][bug_id]['last_change_time']
+        else:
+            return None
@@ -8,27 +8,109 @@ import json
 import copy
 import os
 import time
+import threading
+from multiprocessing.pool import ThreadPool
 
 
 import requests
+import requests.adapters
 
 import util
 import bugdb
 import configuration as c
+import logs
 
 class FailedBZAPICall(Exception): pass
 class InvalidBZAPICredentials(Exception): pass
 class MultipleQueryParam(Exception): pass
 
 
+# These can be overridden in the 'bugzilla.api' section of the configuration
+defaults = {
+    'pool_size': 10, # connections to the API host kept open for reuse
+    'timeout': 60, # seconds to wait for a connection or for data, or a [connect, read] pair
+    'workers': 8, # calls made at the same time by fetch_bugs
+    'requests_per_second': 10, # most calls started in a second, 0 for no limit
+}
+
+
+def setting(name):
+    try:
+        return c.read_value('bugzilla.api.%s' % name)
+    except KeyError:
+        return defaults[name]
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+def session():
+    """Return the requests Session that all API calls of this process go
+    through.  Its connection pool keeps connections to the API host alive
+    between calls, so a call after the first doesn't have to connect and
+    negotiate TLS again.  The pool is shared by every thread"""
+    global _session, _session_pid
+    with _session_lock:
+        # Connections opened before a fork must not be used by the child
+        if _session is None or _session_pid != os.getpid():
+            _session = requests.Session()
+            pool_size = setting('pool_size')
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                    pool_maxsize=pool_size)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _session.headers['Accept-Encoding'] = 'gzip, deflate'
+            _session_pid = os.getpid()
+        return _session
+
+
+class RateLimiter(object):
+    """Space calls out so that no more than rate of them start in any one
+    second, however many threads are making them.  A rate of 0 doesn't
+    limit anything"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_start = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+_rate_limiter = None
+
+def rate_limiter():
+    global _rate_limiter
+    with _session_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter(setting('requests_per_second'))
+        return _rate_limiter
+
+
+def _timeout():
+    timeout = setting('timeout')
+    if isinstance(timeout, list):
+        return tuple(timeout)
+    return timeout
+
+
 def _raw_query(method, url, attempt=1, **kwargs):
     def write_log():
-        with open('uplift_api_calls.log', 'ab+') as f:
-            # Scrubadubdub
-            log_line['url'] = log_line['url'].replace(credentials['password'], '<password>')
-            json.dump(log_line, f, indent=2)
-            f.write(',\n')
-            f.flush()
+        api_log = logs.get_log('uplift_api_calls.log')
+        # Scrubadubdub
+        log_line['url'] = log_line['url'].replace(credentials['password'], '<password>')
+        if log_line.has_key('http_error'):
+            log_line['http_error'] = api_log.cap(log_line['http_error'])
+        api_log.write(log_line)
 
     log_line = {
         'url': url,
@@ -41,7 +123,9 @@ def _raw_query(method, url, attempt=1, **kwargs):
 
     t = util.time_start()
     try:
-        r = requests.request(method, url, **kwargs)
+        kwargs.setdefault('timeout', _timeout())
+        rate_limiter().wait()
+        r = session().request(method, url, **kwargs)
     except requests.exceptions.RequestException as e:
         write_log()
         raise FailedBZAPICall(log_line)
@@ -182,23 +266,153 @@ def parse_bzapi_url(url):
     return flatten_query(urlparse.parse_qs(urlparse.urlparse(url).query, keep_blank_values=True))
 
 
-def search(query):
-    """Take a BzAPI query URL, complete a BzAPI search for it then return a dictionary of information.
-    The returned dict is keyed by bug number.  The field parameter is either a string or a list.
-    If it's a known string (currently basic, all) then a predefined set of bug keys are return.
-    If it's a list, then the keys which match items in fields are returned"""
+def search(query, include_fields=None):
+    """Take a BzAPI query, complete a BzAPI search for it then return the
+    ids of the bugs found.  When include_fields is given, the server is
+    asked for those fields and the bugs are returned as dictionaries of
+    them instead"""
+    if include_fields:
+        query = dict(query, include_fields=include_fields)
     data = do_query(compute_url(query, 'bug'), retry=True)
+    if include_fields:
+        return data['bugs']
     return [x['id'] for x in data['bugs']]
 
 
+# The fields of a bug that fetch_complete_bug returns and the bug cache holds
+complete_fields = "_default,assigned_to,comments,flags"
+
+# Proxies and servers start refusing URLs somewhere after 8k
+max_url_length = 6000
+
+
+def _bug_id_chunks(bug_ids, query):
+    """Split bug_ids into lists that each fit in one 'bug?id=1,2,3' URL
+    along with query"""
+    length = len(compute_url(dict(query, id=''), 'bug'))
+    chunks = []
+    chunk = []
+    chunk_length = length
+    for bug_id in bug_ids:
+        # A comma is quoted as %2C
+        id_length = len(str(bug_id)) + (3 if chunk else 0)
+        if chunk and chunk_length + id_length > max_url_length:
+            chunks.append(chunk)
+            chunk = []
+            chunk_length = length
+            id_length = len(str(bug_id))
+        chunk.append(bug_id)
+        chunk_length += id_length
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def fetch_bugs(bug_ids, include_fields=complete_fields, workers=None):
+    """Fetch any number of bugs with as few calls as fit into URLs, making
+    several of those calls at once.  This returns a dictionary of integer
+    bug id to bug data.  Bugs that the server doesn't return, because they
+    don't exist or can't be seen, are left out.  When the complete fields
+    are asked for, the bugs are also put into the bug cache in one write"""
+    bug_ids = sorted(set(int(x) for x in bug_ids))
+    query = {'include_fields': include_fields}
+    chunks = _bug_id_chunks(bug_ids, query)
+    if len(chunks) == 0:
+        return {}
+
+    def fetch(chunk):
+        chunk_query = dict(query, id=','.join(str(x) for x in chunk))
+        return do_query(compute_url(chunk_query, 'bug'), retry=True)['bugs']
+
+    pool = ThreadPool(min(len(chunks), workers or setting('workers')))
+    try:
+        results = pool.map(fetch, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    bugs = {}
+    for result in results:
+        for bug in result:
+            bugs[int(bug['id'])] = bug
+    if include_fields == complete_fields and len(bugs) > 0:
+        bugdb.store_many(bugs.values())
+        _fetched(bugs.keys())
+    return bugs
+
+
+# Bugs that were served from the bug cache and bugs that had to be
+# downloaded during this run, see cache_report()
+_cache_hits = set()
+_cache_misses = set()
+# Bugs whose cached copy is known to be current during this run
+_fresh = set()
+_cache_lock = threading.Lock()
+
+def _from_cache(bug_ids, fresh=False):
+    with _cache_lock:
+        _cache_hits.update(int(x) for x in bug_ids)
+        if fresh:
+            _fresh.update(int(x) for x in bug_ids)
+
+
+def _fetched(bug_ids):
+    with _cache_lock:
+        _cache_misses.update(int(x) for x in bug_ids)
+        _fresh.update(int(x) for x in bug_ids)
+
+
+def _is_fresh(bug_id):
+    with _cache_lock:
+        return int(bug_id) in _fresh
+
+
+def cache_report():
+    """Return a line about how many bugs the bug cache saved downloading
+    during this run or None if no bug was looked at"""
+    with _cache_lock:
+        misses = len(_cache_misses)
+        hits = len(_cache_hits - _cache_misses)
+    if hits + misses == 0:
+        return None
+    return "Bug cache: %d bugs used from the cache, %d fetched" % (hits, misses)
+
+
+def prefetch_bugs(bug_ids):
+    """Put the bugs of bug_ids that aren't in the bug cache into it with
+    fetch_bugs, so that fetch_complete_bug(cache_ok=True) finds them"""
+    missing = [x for x in bug_ids if not bugdb.load(x)]
+    if len(missing) > 0:
+        fetch_bugs(missing)
+
+
+def revalidate_bugs(bug_ids):
+    """Make sure the bug cache has the current version of each of bug_ids.
+    One batched probe of last_change_time covers every cached bug, and
+    only the bugs that changed or aren't cached are fetched again.  After
+    this, fetch_complete_bug returns them without asking the server"""
+    bug_ids = [x for x in set(int(x) for x in bug_ids) if not _is_fresh(x)]
+    cached = {}
+    for bug_id in bug_ids:
+        bugdb_copy = bugdb.load(bug_id)
+        if bugdb_copy:
+            cached[bug_id] = bugdb_copy
+    current = fetch_bugs(cached.keys(), include_fields='id,last_change_time')
+    unchanged = [x for x in cached.keys() if current.has_key(x) and
+                 current[x].get('last_change_time') == cached[x].get('last_change_time')]
+    _from_cache(unchanged, fresh=True)
+    stale = sorted(set(bug_ids) - set(unchanged))
+    if len(stale) > 0:
+        fetch_bugs(stale)
+
+
 def _fetch_bug(bug_id, all_fields):
     if all_fields:
         query = {
-            'include_fields': "_default,assigned_to,comments,flags"
+            'include_fields': complete_fields
         }
     else:
         query = {
-            'include_fields': 'last_modified_time'
+            'include_fields': 'id,last_change_time'
         }
     return do_query(compute_url(query, 'bug/%d' % int(bug_id)), retry=True)
 
@@ -206,15 +420,18 @@ def _fetch_bug(bug_id, all_fields):
 def fetch_complete_bug(bug_id, cache_ok=False):
     bugdb_copy = bugdb.load(bug_id)
 
-    if bugdb_copy and cache_ok:
+    if bugdb_copy and (cache_ok or _is_fresh(bug_id)):
+        _from_cache([bug_id])
         return bugdb_copy
     elif bugdb_copy:
-        db_last_mod = ['last_change_time']
-        bz_last_mod = _fetch_bug(bug_id, False)
-        if db_last_mod == bz_last_mod:
+        db_last_mod = bugdb_copy.get('last_change_time')
+        bz_last_mod = _fetch_bug(bug_id, False).get('last_change_time')
+        if db_last_mod is not None and db_last_mod == bz_last_mod:
+            _from_cache([bug_id], fresh=True)
             return bugdb_copy
     bug_data = _fetch_bug(bug_id, True)
     bugdb.store(bug_data)
+    _fetched([bug_id])
     return bug_data
 
 # This function is split from update_bug to make testing easier
@@ -236,8 +453,13 @@ def create_updates(bug, comment=None, values=None, flags=None):
 
 
 def update_bug(bug_id, comment=None, values=None, flags=None):
-    bug_data = fetch_complete_bug(bug_id)
+    # The token has to be current, so it never comes from the bug cache
+    bug_data = do_query(compute_url({'include_fields': 'id,update_token'}, 'bug/%d' % int(bug_id)),
+                        retry=True)
     updates = create_updates(bug_data, comment, values, flags)
     url = compute_url({}, "bug/%s" % bug_id)
     result = do_query(url, "put", data=json.dumps(updates))
+    # The cached copy is now out of date
+    with _cache_lock:
+        _fresh.discard(int(bug_id))
 
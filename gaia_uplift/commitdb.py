@@ -0,0 +1,183 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+_schema = [
+    """CREATE TABLE IF NOT EXISTS commits (
+        sha TEXT PRIMARY KEY,
+        parents TEXT NOT NULL,
+        commit_time INTEGER NOT NULL,
+        author_name TEXT NOT NULL,
+        author_email TEXT NOT NULL,
+        author_date TEXT NOT NULL,
+        message TEXT NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS ancestry (
+        commit_sha TEXT NOT NULL,
+        tip_sha TEXT NOT NULL,
+        is_ancestor INTEGER NOT NULL,
+        PRIMARY KEY (commit_sha, tip_sha))""",
+    # Every parent of a commit in the graph is in the graph too
+    """CREATE TABLE IF NOT EXISTS graph (
+        sha TEXT PRIMARY KEY,
+        parents TEXT NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS graph_tips (
+        tip_sha TEXT PRIMARY KEY,
+        added REAL NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS topo_orders (
+        tip_sha TEXT PRIMARY KEY,
+        shas BLOB NOT NULL,
+        added REAL NOT NULL)""",
+]
+
+# SQLite won't take more parameters than this in one statement
+_max_params = 900
+
+# Only the newest of these are kept, older ones are rarely asked about again
+_max_graph_tips = 20
+_max_topo_orders = 4
+
+
+class CommitStore(object):
+    """SQLite database of facts about commits that can never change for a
+    given sha: their metadata, their parents, the topological order of
+    their history and whether one is the ancestor of another.
+    Each thread and process gets its own connection and the database uses
+    write-ahead logging, so parallel uplifts can read while another one
+    writes.  The store is only a cache, so when the database can't be used
+    it answers nothing and forgets what it's told"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+
+    def _conn(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.filename, timeout=30)
+            # Messages and names aren't always utf-8
+            conn.text_factory = str
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in _schema:
+                conn.execute(statement)
+            conn.commit()
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def get_commits(self, shas):
+        """Return a dictionary of sha to (sha, parents, commit_time,
+        author_name, author_email, author_date, message) rows for the shas
+        that are stored.  parents is a tuple"""
+        shas = list(shas)
+        found = {}
+        try:
+            conn = self._conn()
+            for i in range(0, len(shas), _max_params):
+                chunk = shas[i:i + _max_params]
+                rows = conn.execute(
+                    "SELECT sha, parents, commit_time, author_name, author_email, author_date, message "
+                    "FROM commits WHERE sha IN (%s)" % ",".join("?" * len(chunk)), chunk)
+                for row in rows:
+                    found[row[0]] = (row[0], tuple(row[1].split())) + tuple(row[2:])
+        except sqlite3.Error, e:
+            print "WARNING: could not read %s: %s" % (self.filename, e)
+        return found
+
+    def put_commits(self, rows):
+        """Store rows shaped like the ones get_commits returns"""
+        try:
+            conn = self._conn()
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO commits VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 [(x[0], " ".join(x[1])) + tuple(x[2:]) for x in rows])
+        except sqlite3.Error, e:
+            print "WARNING: could not write %s: %s" % (self.filename, e)
+
+    def get_ancestry(self, commit, tip):
+        """Return whether commit is an ancestor of tip or None if that
+        isn't known"""
+        try:
+            row = self._conn().execute(
+                "SELECT is_ancestor FROM ancestry WHERE commit_sha = ? AND tip_sha = ?",
+                (commit, tip)).fetchone()
+        except sqlite3.Error, e:
+            print "WARNING: could not read %s: %s" % (self.filename, e)
+            return None
+        return bool(row[0]) if row else None
+
+    def put_ancestry(self, commit, tip, is_ancestor):
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO ancestry VALUES (?, ?, ?)",
+                             (commit, tip, 1 if is_ancestor else 0))
+        except sqlite3.Error, e:
+            print "WARNING: could not write %s: %s" % (self.filename, e)
+
+    def get_graph(self):
+        """Return every (sha, parents) pair of the stored commit graph.
+        parents is a tuple"""
+        try:
+            rows = self._conn().execute("SELECT sha, parents FROM graph").fetchall()
+        except sqlite3.Error, e:
+            print "WARNING: could not read %s: %s" % (self.filename, e)
+            return []
+        return [(x[0], tuple(x[1].split())) for x in rows]
+
+    def get_graph_tips(self):
+        """Return the newest tips whose whole history was put in the graph"""
+        try:
+            rows = self._conn().execute("SELECT tip_sha FROM graph_tips ORDER BY added DESC LIMIT ?",
+                                        (_max_graph_tips,)).fetchall()
+        except sqlite3.Error, e:
+            print "WARNING: could not read %s: %s" % (self.filename, e)
+            return []
+        return [x[0] for x in rows]
+
+    def put_graph(self, rows, tips):
+        """Store (sha, parents) rows that, together with the graph already
+        stored, hold the whole history of each of tips"""
+        try:
+            conn = self._conn()
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO graph VALUES (?, ?)",
+                                 [(x[0], " ".join(x[1])) for x in rows])
+                conn.executemany("INSERT OR REPLACE INTO graph_tips VALUES (?, ?)",
+                                 [(x, time.time()) for x in tips])
+                conn.execute("DELETE FROM graph_tips WHERE tip_sha NOT IN "
+                             "(SELECT tip_sha FROM graph_tips ORDER BY added DESC LIMIT ?)",
+                             (_max_graph_tips,))
+        except sqlite3.Error, e:
+            print "WARNING: could not write %s: %s" % (self.filename, e)
+
+    def get_topo_order(self, tip):
+        """Return the shas of 'git rev-list --topo-order --reverse tip' or
+        None if that isn't stored"""
+        try:
+            row = self._conn().execute("SELECT shas FROM topo_orders WHERE tip_sha = ?",
+                                       (tip,)).fetchone()
+        except sqlite3.Error, e:
+            print "WARNING: could not read %s: %s" % (self.filename, e)
+            return None
+        if row is None:
+            return None
+        return zlib.decompress(str(row[0])).split()
+
+    def put_topo_order(self, tip, shas):
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO topo_orders VALUES (?, ?, ?)",
+                             (tip, sqlite3.Binary(zlib.compress(" ".join(shas))), time.time()))
+                conn.execute("DELETE FROM topo_orders WHERE tip_sha NOT IN "
+                             "(SELECT tip_sha FROM topo_orders ORDER BY added DESC LIMIT ?)",
+                             (_max_topo_orders,))
+        except sqlite3.Error, e:
+            print "WARNING: could not write %s: %s" % (self.filename, e)
+
+    def close(self):
+        if getattr(self.local, 'pid', None) == os.getpid():
+            self.local.conn.close()
+        self.local = threading.local()
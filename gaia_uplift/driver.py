@@ -14,6 +14,7 @@ import find_commits
 import merge_hd
 import git
 import reporting
+import bzapi
 import util
 import traceback
 import configuration as c
@@ -40,7 +41,10 @@ def main():
 
         print "\n\nUplift requirements:"
         print reporting.display_uplift_requirements(full_requirements)
-        uplift_report = uplift.uplift(gaia_path, gaia_url, full_requirements)
+        uplift_report = uplift.uplift(gaia_path, gaia_url, full_requirements,
+                                      parallel='--parallel' in cmd_args,
+                                      in_memory='--in-memory' in cmd_args,
+                                      batch='--batch' in cmd_args)
         print reporting.display_uplift_report(uplift_report)
         try:
             push_info = uplift.push(gaia_path)
@@ -61,8 +65,20 @@ def main():
             print "ERROR: Pushing failed.  Try doing another uplift, and tell it to 'reuse' commits"
             exit(1)
 
+    elif cmd == 'predict':
+        requirements = uplift.build_uplift_requirements(gaia_path)
+        full_requirements = find_commits.for_all_bugs(gaia_path, requirements)
+        prediction = uplift.predict(gaia_path, gaia_url, full_requirements)
+        print reporting.display_prediction(prediction)
     elif cmd == 'update':
-        git.create_gaia(gaia_path, gaia_url)
+        git.create_gaia(gaia_path, gaia_url, refresh=not '--full' in cmd_args)
+    elif cmd == 'maintain':
+        for repo_dir in [git._cache_dir(gaia_path), gaia_path]:
+            if os.path.isdir(repo_dir):
+                print "Maintaining %s" % repo_dir
+                t = util.time_start()
+                git.maintain_repo(repo_dir)
+                print "Maintained %s in %0.2f seconds" % (repo_dir, util.time_end(t))
     elif cmd == 'merge':
         merge_hd.merge(gaia_path, gaia_url, cmd_args[0], cmd_args[1])
     elif cmd == 'comments':
@@ -90,6 +106,10 @@ def main():
         print "ERROR: You did not specify a command!"
         exit(1)
 
+    report = bzapi.cache_report()
+    if report:
+        print report
+
 
 if __name__ == "__main__":
     main()
@@ -31,8 +31,10 @@ def guess_from_pr(repo_dir, upstream, pr_num):
     return None
 
 
-def guess_from_comments(repo_dir, upstream, comments):
-    commits = {}
+def _find_guesses(comments):
+    """Return a list of (commit_id, reason) pairs for the commit ids that
+    are mentioned in comments and a list of the pull request numbers"""
+    matched = []
     pull_requests = []
     for c in comments:
         if not c.has_key('text') or c.get('text', None) == None or c.get('text', '') == '':
@@ -43,16 +45,10 @@ def guess_from_comments(repo_dir, upstream, comments):
             for m in matches:
                 d = m.groupdict()
                 if d.has_key('id'):
-                    commit_id = d['id']
-                    if git.git_object_type(repo_dir, commit_id) == 'commit':
-                        if git.get_rev(repo_dir, commit_id) and git.commit_on_branch(repo_dir, commit_id, upstream):
-                            if not commits.has_key(commit_id):
-                                commits[commit_id] = []
-                            # The reason should include the person's real name!
-                            reason = "%s made a comment which matched the pattern %s:\n%s\n%s" % (
-                                c['creator']['name'], r.pattern, "-"*80, c_txt)
-
-                            commits[commit_id].append(reason)
+                    # The reason should include the person's real name!
+                    reason = "%s made a comment which matched the pattern %s:\n%s\n%s" % (
+                        c['creator']['name'], r.pattern, "-"*80, c_txt)
+                    matched.append((d['id'], reason))
                 elif d.has_key('pr'):
                     try:
                         pr_num = int(d['pr'], 10)
@@ -61,10 +57,41 @@ def guess_from_comments(repo_dir, upstream, comments):
 
                     if not pr_num in pull_requests:
                         pull_requests.append(pr_num)
+    return matched, pull_requests
+
+
+def _is_upstream_commit(repo_dir, commit_id, upstream):
+    try:
+        # Comments often mention commits that we don't have
+        return git.git_object_type(repo_dir, commit_id) == 'commit' and \
+               git.commit_on_branch(repo_dir, commit_id, upstream)
+    except git.GitError:
+        return False
+
+
+def _upstream_commits(repo_dir, upstream, commit_ids):
+    """Return the set of commit_ids which are commits on upstream.  Each
+    commit is only checked once.  The answers come from the cat-file
+    processes and the reachability index, which only answer one question
+    at a time, so there is nothing to gain from asking in parallel"""
+    return set([x for x in set(commit_ids) if _is_upstream_commit(repo_dir, x, upstream)])
+
+
+def _collect_guesses(matched, valid):
+    commits = {}
+    for commit_id, reason in matched:
+        if commit_id in valid:
+            if not commits.has_key(commit_id):
+                commits[commit_id] = []
+            commits[commit_id].append(reason)
+    return commits
+
 
+def guess_from_comments(repo_dir, upstream, comments):
+    matched, pull_requests = _find_guesses(comments)
     for pr_num in pull_requests:
         guess_from_pr(repo_dir, upstream, pr_num)
-    return commits
+    return _collect_guesses(matched, _upstream_commits(repo_dir, upstream, [x[0] for x in matched]))
 
 
 def guess_from_attachments(repo_dir, upstream, comments):
@@ -73,22 +100,18 @@ def guess_from_attachments(repo_dir, upstream, comments):
 
 def guess_commit(repo_dir, upstream, bug):
     """I take a bug_id and scan the bug comments and attachements to see if I can find
-    some valid commits.  I return a list of (commit, reason) doubles, where the commit
-    is a string of what I think is the case and the reason is a human readable string
-    explaining *why* the commit is likely"""
-    guessed_commits = {}
-
-    def merge(y):
-        for k in y.keys():
-            if not guessed_commits.has_key(k):
-                guessed_commits[k] = []
-            guessed_commits[k].extend(y[k])
-
-    if bug.has_key('comments'):
-        merge(guess_from_comments(repo_dir, upstream, bug['comments']))
-    if bug.has_key('attachments'):
-        merge(guess_from_comments(repo_dir, upstream, bug['attachments']))
-    return guessed_commits
+    some valid commits.  I return a dictionary of commit to a list of reasons, where the commit
+    is a string of what I think is the case and the reasons are human readable strings
+    explaining *why* the commit is likely.  A commit mentioned several times is only
+    checked once"""
+    matched = []
+    for key in ('comments', 'attachments'):
+        if bug.has_key(key):
+            bug_matched, pull_requests = _find_guesses(bug[key])
+            matched.extend(bug_matched)
+            for pr_num in pull_requests:
+                guess_from_pr(repo_dir, upstream, pr_num)
+    return _collect_guesses(matched, _upstream_commits(repo_dir, upstream, [x[0] for x in matched]))
 
 
 def open_bug_in_browser(bug_id):
@@ -282,6 +305,11 @@ def for_all_bugs(repo_dir, requirements, upstream="master"):
         bugs_to_find = requirements.keys()
 
     pruned_bugs_to_find = [x for x in bugs_to_find if not uplift.is_skipable(x)]
+    try:
+        bzapi.prefetch_bugs(pruned_bugs_to_find)
+    except Exception, e:
+        # Each bug is fetched on its own when it's its turn instead
+        print "WARNING: could not fetch the bugs ahead of time: %s" % e
     j=0
     for bug_id in sorted(pruned_bugs_to_find):
         j+=1
@@ -3,31 +3,43 @@
 import os
 import subprocess as sp
 import shutil
-import isodate
 import re
 import json
 import traceback
 import copy
+import threading
+import atexit
+import collections
+import urllib
+import pipes
+import time
 
 import configuration as c
+import logs
+import commitdb
 
 class GitError(Exception): pass
 
 # TODO: Come up with a better name!
 class GitNoop(GitError): pass
 
-class PushFailure(GitError): pass
+class PushFailure(GitError):
+    def __init__(self, message='', rejected=None):
+        GitError.__init__(self, message)
+        # Branch name -> the reason the remote gave for rejecting it
+        self.rejected = rejected or {}
 
 git_bin = 'git'
 valid_id_regex = "[a-fA-F0-9]{7,40}"
 
-def run_cmd(command, workdir, read_out=True, env=None, delete_env=None, **kwargs):
+def run_cmd(command, workdir, read_out=True, env=None, delete_env=None, input=None, **kwargs):
     """ Wrap subprocess in a way that I like.
     command: string or list of the command to run
     workdir: directory to do the work in
     read_out: decide whether we're going to want output returned or printed
     env: add this dictionary to the default environment
-    delete_env: delete these environment keys"""
+    delete_env: delete these environment keys
+    input: string to write to the command's stdin"""
     full_env = dict(os.environ)
     if env:
         full_env.update(env)
@@ -40,24 +52,23 @@ def run_cmd(command, workdir, read_out=True, env=None, delete_env=None, **kwargs
     kwargs['stderr'] = sp.PIPE
     if read_out:
         kwargs['stdout'] = sp.PIPE
+    if input is not None:
+        kwargs['stdin'] = sp.PIPE
 
     proc = sp.Popen(command, cwd=workdir, env=full_env, **kwargs)
 
-    stdout, stderr = proc.communicate()
-
-    with open("cmds.log", "ab+") as cmd_log:
-        log_line = {
-            'command': command,
-            'cwd': os.getcwd(),
-            'workdir': workdir,
-            'env': env,
-            'exit_code': proc.returncode,
-            'stdout': stdout,
-            'stderr': stderr
-        }
-        json.dump(log_line, cmd_log, indent=2)
-        cmd_log.write(',\n')
-        cmd_log.flush()
+    stdout, stderr = proc.communicate(input)
+
+    cmd_log = logs.get_log("cmds.log")
+    cmd_log.write({
+        'command': command,
+        'cwd': os.getcwd(),
+        'workdir': workdir,
+        'env': env,
+        'exit_code': proc.returncode,
+        'stdout': cmd_log.cap(stdout),
+        'stderr': cmd_log.cap(stderr)
+    })
 
     if proc.returncode != 0:
         raise sp.CalledProcessError(proc.returncode, command, stdout)
@@ -76,11 +87,131 @@ def git_op(command, workdir=os.getcwd(), **kwargs):
                         'options': kwargs,
                         'super_exc': e,
                         'traceback': traceback.format_exc()})
+    finally:
+        # Even a failed command may have moved some of them
+        if len(command) > 0 and command[0] in _ref_moving_ops:
+            invalidate_refs()
+
+
+class ObjectQueryService(object):
+    """I keep a 'git cat-file --batch-check' and a 'git cat-file --batch'
+    process open for a repository and answer object lookups over their
+    pipes instead of starting a new git process for every question.  The
+    processes are only started when they are first needed"""
+
+    _info_re = re.compile("^(?P<sha>[a-f0-9]{40}) (?P<type>\\S+) (?P<size>\\d+)$")
+
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        # Forked children must not share our pipes, see object_service()
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.procs = {}
+
+    def _proc(self, mode):
+        proc = self.procs.get(mode)
+        if proc is None or proc.poll() is not None:
+            env = dict(os.environ)
+            if mode == "--batch-check":
+                # Looking up a guessed commit id must not go off and fetch
+                # it in a partial clone.  Contents are only asked for when
+                # they are really needed, so those may still be fetched
+                env['GIT_NO_LAZY_FETCH'] = '1'
+            with open(os.devnull, 'w') as devnull:
+                proc = sp.Popen([git_bin, "cat-file", mode], cwd=self.repo_dir, env=env,
+                                stdin=sp.PIPE, stdout=sp.PIPE, stderr=devnull)
+            self.procs[mode] = proc
+        return proc
+
+    def _ask(self, mode, name):
+        """Send a single object name to the cat-file process and return
+        the header line and the process so that content can be read"""
+        for attempt in range(2):
+            proc = self._proc(mode)
+            try:
+                proc.stdin.write(name + '\n')
+                proc.stdin.flush()
+                header = proc.stdout.readline()
+            except IOError:
+                header = ''
+            if header.endswith('\n'):
+                return header.rstrip('\n'), proc
+            # The process went away underneath us, try a fresh one
+            self._stop(mode)
+        raise GitError("cat-file %s in %s stopped answering" % (mode, self.repo_dir))
+
+    def info(self, name):
+        """Return a (sha, type, size) tuple for name or None if the
+        name does not resolve to exactly one object"""
+        if not name or name.strip() != name or '\n' in name:
+            return None
+        with self.lock:
+            header = self._ask("--batch-check", name)[0]
+        match = self._info_re.match(header)
+        if not match:
+            return None
+        return match.group('sha'), match.group('type'), int(match.group('size'))
+
+    def contents(self, name):
+        """Return a (sha, type, contents) tuple for name or None if the
+        name does not resolve to exactly one object"""
+        if not name or name.strip() != name or '\n' in name:
+            return None
+        with self.lock:
+            header, proc = self._ask("--batch", name)
+            match = self._info_re.match(header)
+            if not match:
+                return None
+            data = proc.stdout.read(int(match.group('size')))
+            proc.stdout.read(1) # Each object is followed by a newline
+        return match.group('sha'), match.group('type'), data
+
+    def _stop(self, mode):
+        proc = self.procs.pop(mode, None)
+        if proc and proc.poll() is None:
+            try:
+                proc.stdin.close()
+                proc.wait()
+            except (IOError, OSError):
+                pass
+
+    def close(self):
+        with self.lock:
+            for mode in self.procs.keys():
+                self._stop(mode)
+
+
+_object_services = {}
+
+def object_service(repo_dir):
+    """Return the ObjectQueryService for repo_dir, creating it if needed"""
+    key = os.path.abspath(repo_dir)
+    service = _object_services.get(key)
+    if service is None or service.pid != os.getpid():
+        service = _object_services[key] = ObjectQueryService(key)
+    return service
+
+
+def close_object_services(repo_dir=None):
+    """Stop the cat-file processes for repo_dir or for all repositories"""
+    if repo_dir:
+        keys = [os.path.abspath(repo_dir)]
+    else:
+        keys = _object_services.keys()
+    for key in keys:
+        service = _object_services.pop(key, None)
+        if service and service.pid == os.getpid():
+            service.close()
+
+atexit.register(close_object_services)
 
 
 def get_rev(repo_dir, id='HEAD'):
     """Get the full sha1 commit id of a git repository"""
-    return git_op(["rev-parse", id], workdir=repo_dir).strip()
+    info = object_service(repo_dir).info(id)
+    if not info:
+        raise GitError("'%s' does not name an object in %s" % (id, repo_dir))
+    return info[0]
 
 
 def show(repo_dir, id='HEAD', template="oneline"):
@@ -91,47 +222,256 @@ def valid_id(id):
     return re.match("^%s$" % valid_id_regex, id) != None
 
 
-def _parse_branches(cmd_out):
-    branches=[]
-    for line in [x.strip() for x in cmd_out.split('\n')]:
-        if line == '':
-            continue
-        elif line[:2] == "* ":
-            branches.append(line[2:])
-        else:
-            branches.append(line)
-    return branches
+class RefSnapshot(object):
+    """Every local branch and remote-tracking ref of a repository with the
+    sha it points to, read by a single 'git for-each-ref'.  Lookups are
+    dictionary lookups.  The snapshot doesn't notice refs moving by
+    itself, git_op throws the snapshots away whenever it runs a command
+    that can move them, so only changes made by something other than
+    gaia_uplift can be missed"""
+
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        self.refs = {}
+        self.head = None
+        output = git_op(["for-each-ref", "--format=%(HEAD)%00%(refname)%00%(objectname)",
+                         "refs/heads", "refs/remotes"], workdir=repo_dir)
+        for line in output.splitlines():
+            if line == '':
+                continue
+            head, refname, sha = line.split('\0')
+            self.refs[refname] = sha
+            if head == '*' and refname.startswith('refs/heads/'):
+                self.head = refname[len('refs/heads/'):]
+
+    def _full_name(self, ref):
+        if ref.startswith('refs/'):
+            return ref
+        return 'refs/heads/%s' % ref
+
+    def has_branch(self, branch):
+        return self.refs.has_key('refs/heads/%s' % branch)
+
+    def tip(self, ref):
+        """Return the sha that a branch name or full ref name points to or
+        None if there is no such ref"""
+        return self.refs.get(self._full_name(ref))
+
+    def branches(self):
+        return sorted(x[len('refs/heads/'):] for x in self.refs.keys()
+                      if x.startswith('refs/heads/'))
+
+    def current_branch(self):
+        """Return the checked out branch or None if HEAD is detached"""
+        return self.head
+
+
+_ref_snapshots = {}
+_ref_snapshots_lock = threading.Lock()
+
+# Commands that can create, delete or move a ref or HEAD
+_ref_moving_ops = set(["checkout", "cherry-pick", "reset", "push", "fetch", "pull", "merge",
+                       "rebase", "revert", "commit", "branch", "update-ref", "symbolic-ref",
+                       "worktree", "remote", "clone", "init", "tag", "am", "stash"])
+
+def ref_snapshot(repo_dir):
+    """Return the RefSnapshot for repo_dir, reading the refs if nothing
+    has been read since they last moved"""
+    key = os.path.abspath(repo_dir)
+    with _ref_snapshots_lock:
+        snapshot = _ref_snapshots.get(key)
+    if snapshot is None:
+        snapshot = RefSnapshot(key)
+        with _ref_snapshots_lock:
+            _ref_snapshots[key] = snapshot
+    return snapshot
+
+
+def invalidate_refs():
+    """Forget every RefSnapshot.  Worktrees share their refs with the
+    repository they were added to, so they are all thrown away together"""
+    with _ref_snapshots_lock:
+        _ref_snapshots.clear()
 
 
 def branches(repo_dir):
-    cmd_out = git_op(["branch"], workdir=repo_dir)
-    return _parse_branches(cmd_out)
+    return ref_snapshot(repo_dir).branches()
 
 def current_branch(repo_dir):
-    cmd_out = git_op(["branch"], workdir=repo_dir)
-    for line in [x.strip() for x in cmd_out.split('\n')]:
-        if line[:2] == "* ":
-            return line[2:]
-    return None
+    return ref_snapshot(repo_dir).current_branch()
+
+
+class ReachabilityIndex(object):
+    """I know which commits are reachable from a set of local branches.
+    The commit graph comes from the commit store, and only the commits it
+    doesn't have yet are read with a 'git rev-list --parents' and added
+    to it, so a run whose branches haven't moved starts no git process.
+    Each branch gets a bytearray that is indexed by commit position, so
+    asking whether a commit is on a branch is a lookup instead of a
+    history walk.  Before answering, I check the branch tip and catch up
+    with any commits added since the last question, which is normally
+    just the commit a cherry-pick created"""
+
+    def __init__(self, repo_dir, branches):
+        self.repo_dir = repo_dir
+        self.branches = list(branches)
+        self.lock = threading.RLock()
+        self.store = commit_store(repo_dir)
+        self.shas = []
+        self.position = {}
+        self.parents = []
+        self.tips = {}
+        self.reachable = {}
+        stored = self.store.get_graph()
+        for sha, parents in stored:
+            self.position[sha] = len(self.shas)
+            self.shas.append(sha)
+        for sha, parents in stored:
+            self.parents.append([self.position[x] for x in parents if x in self.position])
+        tips = {}
+        for branch in branches:
+            tip = self._tip(branch)
+            if tip:
+                tips[branch] = tip
+        self._add_commits(tips.values())
+        for branch, tip in tips.items():
+            self._mark(branch, tip)
+
+    def _tip(self, branch):
+        info = object_service(self.repo_dir).info("refs/heads/%s" % branch)
+        return info[0] if info else None
+
+    def _add_commits(self, tips):
+        """Read the part of the commit graph that is reachable from tips
+        but not from any branch tip that we already know about"""
+        tips = [x for x in tips if not x in self.position]
+        if len(tips) == 0:
+            return
+        command = ["rev-list", "--parents"] + tips
+        # The history of any of these is already in the graph.  Stored tips
+        # might come from a scratch copy that was thrown away since
+        service = object_service(self.repo_dir)
+        known = set(self.tips.values())
+        known.update(x for x in self.store.get_graph_tips() if x in self.position and service.info(x))
+        if len(known) > 0:
+            command += ["--not"] + sorted(known)
+        lines = [x.split() for x in git_op(command, workdir=self.repo_dir).splitlines() if x.strip()]
+        lines = [x for x in lines if not x[0] in self.position]
+        first = len(self.shas)
+        for line in lines:
+            self.position[line[0]] = len(self.shas)
+            self.shas.append(line[0])
+        for line in lines:
+            # Parents outside of the graph can only come from a shallow history
+            self.parents.append([self.position[x] for x in line[1:] if x in self.position])
+        for marks in self.reachable.values():
+            marks.extend(bytearray(len(self.shas) - first))
+        self.store.put_graph([(x[0], x[1:]) for x in lines], tips)
+
+    def _mark(self, branch, tip):
+        """Mark every commit reachable from tip as being on branch.  If the
+        branch moved forward, only the new commits are visited"""
+        old_pos = self.position.get(self.tips.get(branch))
+        marks = self.reachable.get(branch)
+        incremental = marks is not None and old_pos is not None
+        if not incremental:
+            marks = bytearray(len(self.shas))
+        found_old = False
+        stack = [self.position[tip]]
+        while stack:
+            pos = stack.pop()
+            if marks[pos]:
+                if pos == old_pos:
+                    found_old = True
+                continue
+            marks[pos] = 1
+            stack.extend(self.parents[pos])
+        if incremental and not found_old:
+            # The branch was moved somewhere that doesn't contain its old
+            # tip, so the old marks are not valid any longer
+            del self.reachable[branch]
+            del self.tips[branch]
+            return self._mark(branch, tip)
+        self.reachable[branch] = marks
+        self.tips[branch] = tip
+
+    def refresh(self, branch):
+        """Bring branch up to date with its tip.  Returns the tip or None
+        if the branch doesn't exist"""
+        tip = self._tip(branch)
+        with self.lock:
+            if tip is None:
+                self.reachable.pop(branch, None)
+                self.tips.pop(branch, None)
+            elif self.tips.get(branch) != tip:
+                self._add_commits([tip])
+                self._mark(branch, tip)
+        return tip
+
+    def covers(self, branch):
+        """Return True if branch was one of the branches I was built for"""
+        return branch in self.branches
+
+    def contains(self, commit, branch):
+        """Return True if the full sha commit is reachable from branch"""
+        with self.lock:
+            if self.refresh(branch) is None:
+                return False
+            pos = self.position.get(commit)
+            return pos is not None and self.reachable[branch][pos] == 1
+
+
+_reachability = {}
+_reachability_lock = threading.Lock()
+
+def reachability_index(repo_dir):
+    """Return the ReachabilityIndex for repo_dir.  It is built on first
+    use from master and the enabled branches.  Other branches can be
+    added by asking about them, but commit_on_branch doesn't"""
+    key = os.path.abspath(repo_dir)
+    with _reachability_lock:
+        if not _reachability.has_key(key):
+            branches = ['master'] + c.read_value('repository.enabled_branches')
+            _reachability[key] = ReachabilityIndex(key, branches)
+        return _reachability[key]
 
 
 def commit_on_branch(repo_dir, commit, branch):
     """ Determine if commit is on a local branch"""
-    obj_type = git_object_type(repo_dir, commit)
+    service = object_service(repo_dir)
+    info = service.info(commit.strip())
+    if not info:
+        raise GitError("'%s' does not name an object in %s" % (commit, repo_dir))
+    obj_type = info[1]
     if obj_type != 'commit':
         print "WARNING: %s is not a commit, rather a %s" % (commit, obj_type)
-    try:
-        cmd_out = git_op(["branch", "--contains", commit], workdir=repo_dir)
-    except sp.CalledProcessError, e:
-        return False
-    if branch in _parse_branches(cmd_out):
-        return True
-    else:
+        info = service.info("%s^{commit}" % info[0])
+        if not info:
+            return False
+    index = reachability_index(repo_dir)
+    if index.covers(branch):
+        return index.contains(info[0], branch)
+    # For the odd other branch, one ancestry question is much cheaper than
+    # reading its history into the index
+    tip = service.info("refs/heads/%s" % branch)
+    if not tip:
         return False
+    return is_ancestor(repo_dir, info[0], tip[0])
 
 
 def git_object_type(repo_dir, o_id):
-    return git_op(["cat-file", "-t", o_id.strip()], workdir=repo_dir).strip()
+    info = object_service(repo_dir).info(o_id.strip())
+    if not info:
+        raise GitError("'%s' does not name an object in %s" % (o_id, repo_dir))
+    return info[1]
+
+
+def read_object(repo_dir, o_id):
+    """Return the raw contents of the object named by o_id"""
+    contents = object_service(repo_dir).contents(o_id.strip())
+    if not contents:
+        raise GitError("'%s' does not name an object in %s" % (o_id, repo_dir))
+    return contents[2]
 
 
 def determine_cherry_pick_master_number(repo_dir, commit, upstream):
@@ -149,8 +489,231 @@ def determine_cherry_pick_master_number(repo_dir, commit, upstream):
         return None
 
 
-def checkout(repo_dir, commitish=None, tracking=None, branch_name=None):
+def _commit_db_file(repo_dir):
+    """The commit store lives in the Gaia mirror that the repository
+    repo_dir belongs to was cloned from, so it outlives the scratch copy.
+    A repository without a mirror keeps it next to itself"""
+    common_dir = git_op(["rev-parse", "--git-common-dir"], workdir=repo_dir).strip()
+    common_dir = os.path.abspath(os.path.join(repo_dir, common_dir))
+    if os.path.basename(common_dir) == '.git':
+        common_dir = os.path.dirname(common_dir)
+    mirror = _cache_dir(common_dir)
+    if os.path.isdir(mirror):
+        return os.path.join(mirror, "uplift-commits.sqlite")
+    parent, name = os.path.split(common_dir.rstrip(os.sep))
+    return os.path.join(parent, ".%s.commits.sqlite" % name)
+
+
+_commit_stores = {}
+
+def commit_store(repo_dir):
+    """Return the CommitStore shared by repo_dir and its worktrees"""
+    key = os.path.abspath(repo_dir)
+    if not _commit_stores.has_key(key):
+        filename = _commit_db_file(key)
+        for store in _commit_stores.values():
+            if store.filename == filename:
+                _commit_stores[key] = store
+                break
+        else:
+            _commit_stores[key] = commitdb.CommitStore(filename)
+    return _commit_stores[key]
+
+
+def close_commit_stores():
+    for store in set(_commit_stores.values()):
+        store.close()
+    _commit_stores.clear()
+
+atexit.register(close_commit_stores)
+
+
+# (commit sha, descendant sha) -> bool.  Shas never change, so neither
+# do these answers and they are shared by every repository
+_ancestry = {}
+
+def is_ancestor(repo_dir, a, b):
+    """Determine if commit a is an ancestor of commit b.  Each answer is
+    remembered by the two shas for this run and in the commit store for
+    later ones, so asking whether a commit is on a branch is only a git
+    process the first time for each branch tip"""
+    key = (get_rev(repo_dir, a), get_rev(repo_dir, b))
+    if not _ancestry.has_key(key):
+        store = commit_store(repo_dir)
+        answer = store.get_ancestry(key[0], key[1])
+        if answer is None:
+            try:
+                git_op(["merge-base", "--is-ancestor", key[0], key[1]], workdir=repo_dir)
+                answer = True
+            except GitError, e:
+                if e.args[0]['super_exc'].returncode != 1:
+                    # Not a 'no', git couldn't answer
+                    raise
+                answer = False
+            store.put_ancestry(key[0], key[1], answer)
+        _ancestry[key] = answer
+    return _ancestry[key]
+
+
+_picked_from_re = re.compile(r"\(cherry picked from commit ([0-9a-f]{40})\)")
+
+# A commit's patch-id never changes, so these are shared by every repository
+_commit_patch_ids = {}
+
+def commit_patch_id(repo_dir, commit, upstream='master'):
+    """Return the stable patch-id of the change 'commit' makes, or None if
+    it doesn't change anything.  For merge commits this is the change
+    against the parent on upstream, which is what cherry-picking it with -m
+    applies"""
+    sha = get_rev(repo_dir, commit)
+    if not _commit_patch_ids.has_key(sha):
+        parents = find_parents(repo_dir, sha)
+        master_num = determine_cherry_pick_master_number(repo_dir, sha, upstream)
+        if master_num:
+            base = parents[int(master_num[2:]) - 1]
+        elif len(parents) > 0:
+            base = parents[0]
+        else:
+            base = "--root"
+        # Both sides of the comparison must diff the same way, see _scan
+        diff = git_op(["diff-tree", "-p", "--no-color", "--no-renames", base, sha], workdir=repo_dir)
+        output = git_op(["patch-id", "--stable"], workdir=repo_dir, input=diff).split()
+        _commit_patch_ids[sha] = output[0] if len(output) > 0 else None
+    return _commit_patch_ids[sha]
+
+
+# Saved indexes in another format are built again.  Version 2 computes
+# patch-ids without rename detection
+_patch_index_format = 2
+
+
+class PatchIndex(object):
+    """Index of the changes that only exist on a branch, to notice commits
+    that were uplifted before under a different sha.  For every branch,
+    the patch-ids of the commits on it but not on upstream are stored
+    together with the '(cherry picked from commit ...)' lines cherry-pick
+    -x leaves in them.  The index for each branch is saved in the git
+    directory with the branch tip it was built from, so that it only has
+    to look at the new commits the next time"""
+
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        common_dir = git_op(["rev-parse", "--git-common-dir"], workdir=repo_dir).strip()
+        self.cache_dir = os.path.join(repo_dir, common_dir, "uplift-patch-ids")
+        # Computing patch-ids needs every blob the commits touch, which a
+        # partial clone would have to download one by one.  Those only use
+        # the cherry-pick lines
+        self.partial = is_partial_clone(repo_dir)
+        self.branches = {}
+
+    def _path(self, branch):
+        return os.path.join(self.cache_dir, "%s.json" % urllib.quote(branch, safe=''))
+
+    def _load(self, branch):
+        try:
+            with open(self._path(branch)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _save(self, branch, entry):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        # Parallel uplifts might save at the same time, so replace atomically
+        tmp = "%s.%d" % (self._path(branch), os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(entry, f)
+        os.rename(tmp, self._path(branch))
+
+    def _scan(self, revs, entry):
+        log = ''
+        if not self.partial:
+            # log would detect renames where commit_patch_id's diff-tree
+            # doesn't, which gives a renaming commit a different patch-id
+            log = git_op(["log", "-p", "--no-merges", "--no-color", "--no-renames"] + revs,
+                         workdir=self.repo_dir)
+        if log.strip():
+            for line in git_op(["patch-id", "--stable"], workdir=self.repo_dir, input=log).splitlines():
+                patch_id, sha = line.split()
+                entry['patch_ids'][patch_id] = sha
+        messages = git_op(["log", "--pretty=format:%H%x00%B%x01"] + revs, workdir=self.repo_dir)
+        for record in messages.split("\x01"):
+            if "\x00" in record:
+                sha, message = record.strip().split("\x00", 1)
+                for picked in _picked_from_re.findall(message):
+                    entry['picked'][picked] = sha
+
+    def refresh(self, branch, upstream='master'):
+        """Bring the index of branch up to date with its tip"""
+        tip = get_rev(self.repo_dir, "refs/heads/%s" % branch)
+        entry = self.branches.get(branch) or self._load(branch)
+        if entry and entry.get('format') != _patch_index_format:
+            entry = None
+        if entry and entry['tip'] == tip and entry['upstream'] == upstream:
+            self.branches[branch] = entry
+            return entry
+        revs = [tip, "^refs/heads/%s" % upstream]
+        if entry and entry['upstream'] == upstream and \
+                object_service(self.repo_dir).info(entry['tip']) and \
+                is_ancestor(self.repo_dir, entry['tip'], tip):
+            revs.append("^%s" % entry['tip'])
+        else:
+            entry = {'format': _patch_index_format, 'upstream': upstream,
+                     'patch_ids': {}, 'picked': {}}
+        self._scan(revs, entry)
+        entry['tip'] = tip
+        self.branches[branch] = entry
+        self._save(branch, entry)
+        return entry
+
+    def equivalent(self, commit, branch, upstream='master'):
+        """Return the commit on branch that makes the same change as commit
+        or None if there isn't one"""
+        entry = self.refresh(branch, upstream)
+        sha = get_rev(self.repo_dir, commit)
+        if entry['picked'].has_key(sha):
+            return entry['picked'][sha]
+        if self.partial:
+            return None
+        patch_id = commit_patch_id(self.repo_dir, sha, upstream)
+        if patch_id:
+            return entry['patch_ids'].get(patch_id)
+        return None
+
+
+_patch_indexes = {}
+
+def patch_index(repo_dir):
+    key = os.path.abspath(repo_dir)
+    if not _patch_indexes.has_key(key):
+        _patch_indexes[key] = PatchIndex(key)
+    return _patch_indexes[key]
+
+
+def patch_on_branch(repo_dir, commit, branch, upstream='master'):
+    """Return the commit on branch that was uplifted from commit, even
+    under a different sha, or None"""
+    return patch_index(repo_dir).equivalent(commit, branch, upstream)
+
+
+def check_pickable(repo_dir, commit, branch, upstream='master'):
+    """Raise GitError if commit can't be cherry-picked from upstream and
+    GitNoop if branch already has it, either as is or as another commit
+    with the same change"""
+    if not commit_on_branch(repo_dir, commit, upstream):
+        raise GitError("commit %s is not on upstream branch %s" % (commit, upstream))
+    elif commit_on_branch(repo_dir, commit, branch):
+        raise GitNoop("trying to cherry-pick '%s' to '%s' which already contains it" % (commit, branch))
+    equivalent = patch_on_branch(repo_dir, commit, branch, upstream)
+    if equivalent:
+        raise GitNoop("trying to cherry-pick '%s' to '%s' which already has it as '%s'" % (
+            commit, branch, equivalent))
+
+
+def checkout(repo_dir, commitish=None, tracking=None, branch_name=None, detach=False):
     cmd = ["checkout"]
+    if detach:
+        cmd.append("--detach")
     if tracking:
         cmd.extend(["-t", tracking])
     if branch_name:
@@ -188,20 +751,111 @@ def cherry_pick(repo_dir, commit, branch, upstream='master'):
     git_op(["checkout", branch], workdir=repo_dir)
     # If the branch already has this commit, we don't want to re-cherry-pick it
     # but instead would like to return the original commit
-    if not commit_on_branch(repo_dir, commit, upstream):
-        raise GitError("commit %s is not on upstream branch %s" % (commit, upstream))
-    elif commit_on_branch(repo_dir, commit, branch):
-        raise GitNoop("trying to cherry-pick '%s' to '%s' which already contains it" % (commit, branch))
-    else:
-        command = ["cherry-pick", "-x"] # -x leaves some breadcrumbs
-        master_num = determine_cherry_pick_master_number(repo_dir, commit, upstream)
-        if master_num:
-            command.append(master_num)
-        command.append(commit)
-        git_op(command, workdir=repo_dir)
+    check_pickable(repo_dir, commit, branch, upstream)
+    command = ["cherry-pick", "-x"] # -x leaves some breadcrumbs
+    master_num = determine_cherry_pick_master_number(repo_dir, commit, upstream)
+    if master_num:
+        command.append(master_num)
+    command.append(commit)
+    git_op(command, workdir=repo_dir)
     return get_rev(repo_dir)
 
 
+def cherry_pick_sequence(repo_dir, commits, branch, master_num=None):
+    """Cherry-pick all of 'commits' onto 'branch' with a single 'git cherry-pick
+    -x' and return the new commits in the same order.  master_num is passed
+    along as cherry-pick's -m parameter for every commit.  If any commit
+    fails, the whole sequence is aborted, the branch is left where it was
+    and a GitError is raised"""
+    reset(repo_dir)
+    git_op(["checkout", branch], workdir=repo_dir)
+    start = get_rev(repo_dir)
+    command = ["cherry-pick", "-x"]
+    if master_num:
+        command.append(master_num)
+    try:
+        git_op(command + list(commits), workdir=repo_dir)
+    except GitError:
+        try:
+            git_op(["cherry-pick", "--abort"], workdir=repo_dir)
+        except GitError:
+            reset(repo_dir, start)
+        raise
+    new_commits = git_op(["rev-list", "--reverse", "%s..HEAD" % start], workdir=repo_dir).split()
+    if len(new_commits) != len(commits):
+        reset(repo_dir, start)
+        raise GitError("cherry-picking %d commits onto %s created %d commits" % (
+            len(commits), branch, len(new_commits)))
+    return new_commits
+
+
+_trailer_re = re.compile("^([\\w-]+: |\\(cherry picked from commit )")
+
+def cherry_pick_message(message, commit):
+    """Return message with the same breadcrumb that 'git cherry-pick -x'
+    leaves.  Like git, the line joins an existing block of trailers"""
+    message = message.rstrip('\n')
+    paragraphs = message.split('\n\n')
+    if len(paragraphs) > 1 and all([_trailer_re.match(x) for x in paragraphs[-1].split('\n')]):
+        separator = '\n'
+    else:
+        separator = '\n\n'
+    return "%s%s(cherry picked from commit %s)\n" % (message, separator, commit)
+
+
+def pick_commit_objects(repo_dir, commit, onto, upstream='master'):
+    """Create a commit which applies 'commit' on top of the commit 'onto'
+    without using a worktree or an index.  The new commit is returned but
+    nothing points to it yet.  Conflicts raise a GitError and a pick which
+    changes nothing because onto already has the change raises GitNoop"""
+    info = commit_info(repo_dir, commit)
+    if len(info.parents) == 0:
+        raise GitError("commit %s has no parent to cherry-pick against" % commit)
+    master_num = determine_cherry_pick_master_number(repo_dir, commit, upstream)
+    parent = info.parents[int(master_num[2:]) - 1] if master_num else info.parents[0]
+
+    # merge-tree --write-tree finds its own merge base.  Giving it a stand-in
+    # commit with onto's tree whose only parent is the parent of the picked
+    # commit makes that parent the merge base, which is the 3-way merge that
+    # cherry-pick does
+    stand_in = git_op(["commit-tree", "%s^{tree}" % onto, "-p", parent, "-m", "uplift stand-in"],
+                      workdir=repo_dir).strip()
+    try:
+        tree = git_op(["merge-tree", "--write-tree", "--name-only", "--messages",
+                       stand_in, info.sha], workdir=repo_dir).splitlines()[0]
+    except GitError, e:
+        super_exc = e.args[0]['super_exc']
+        if super_exc.returncode != 1:
+            raise
+        raise GitError("cherry-pick of %s onto %s has conflicts:\n%s" % (
+            commit, onto, "\n".join(super_exc.output.splitlines()[1:])))
+    if tree == get_rev(repo_dir, "%s^{tree}" % onto):
+        raise GitNoop("cherry-pick of %s onto %s would be empty" % (commit, onto))
+    env = {
+        'GIT_AUTHOR_NAME': info.author_name,
+        'GIT_AUTHOR_EMAIL': info.author_email,
+        'GIT_AUTHOR_DATE': info.author_date
+    }
+    return git_op(["commit-tree", tree, "-p", onto, "-F", "-"], workdir=repo_dir, env=env,
+                  input=cherry_pick_message(info.message, info.sha)).strip()
+
+
+def cherry_pick_objects(repo_dir, commit, branch, upstream='master'):
+    """Cherry-pick 'commit' onto 'branch' like cherry_pick does, but only by
+    creating objects and moving the branch with update-ref.  Nothing is
+    checked out, so several branches can be updated at the same time.  If
+    branch is checked out somewhere, that worktree is left behind the
+    branch until it is reset"""
+    check_pickable(repo_dir, commit, branch, upstream)
+    ref = "refs/heads/%s" % branch
+    tip = get_rev(repo_dir, ref)
+    new_rev = pick_commit_objects(repo_dir, commit, tip, upstream)
+    # Giving the old value makes the update fail if the branch moved meanwhile
+    git_op(["update-ref", "-m", "uplift: cherry-pick %s" % commit, ref, new_rev, tip],
+           workdir=repo_dir)
+    return new_rev
+
+
 def log(repo_dir, commitish, number=None, pretty=None):
     cmd = ["log", commitish]
     if number:
@@ -222,66 +876,178 @@ def reset(repo_dir, id="HEAD", hard=True):
 def a_before_b(repo_dir, branch, commit_times, a, b):
     """Return True if a's commit time on branch is older than b's commit time on branch"""
     # commit_times is a dictionary that gets passed in by reference and is used to
-    # cache the output of the time parsing logic.  it can be {}
-    def fix_git_timestamp(timestamp):
-        """Yay git for generating non-ISO8601 datetime stamps.  Git generates, e.g.
-        2013-01-29 16:06:52 -0800 but ISO8601 would be 2013-01-29T16:06:52-0800"""
-        as_list = list(timestamp)
-        as_list[10] = 'T'
-        del as_list[19]
-        return "".join(as_list)
+    # cache the commit times.  it can be {}
     def get_commit_time(commit):
-        # This value should be cached
-        if commit_times.has_key(commit):
-            git_time = commit_times[commit]
-        else:
-            git_time = git_op(["log", "--branches=%s" % branch, "-n1", commit, "--pretty=%ci"], workdir=repo_dir).strip()
-            commit_times[commit] = git_time
-        return isodate.parse_datetime(fix_git_timestamp(git_time))
+        if not commit_times.has_key(commit):
+            commit_times[commit] = commit_info(repo_dir, commit).commit_time
+        return commit_times[commit]
     a_time = get_commit_time(a)
     b_time = get_commit_time(b)
     if a_time == b_time:
-        raise Exception("Trying to compare two commit times that are the same %s and %s (%s)" % (a,b,a_time))
+        # Commits made in the same second still need a stable order
+        return a < b
     return a_time < b_time
 
 
+_topo_positions = {}
+
+def topo_positions(repo_dir, branch):
+    """Return a dictionary mapping every commit on branch to its position
+    in a single 'git rev-list --topo-order --reverse' walk, oldest first.
+    The walk is kept in the commit store by branch tip, so it is only
+    redone when the branch tip moves"""
+    tip = get_rev(repo_dir, branch)
+    key = (os.path.abspath(repo_dir), tip)
+    if not _topo_positions.has_key(key):
+        store = commit_store(repo_dir)
+        shas = store.get_topo_order(tip)
+        if shas is None:
+            shas = git_op(["rev-list", "--topo-order", "--reverse", tip], workdir=repo_dir).split()
+            store.put_topo_order(tip, shas)
+        positions = {}
+        for sha in shas:
+            positions[sha] = len(positions)
+        # Only the most recent tip of each repository is worth keeping
+        for old_key in [x for x in _topo_positions.keys() if x[0] == key[0]]:
+            del _topo_positions[old_key]
+        _topo_positions[key] = positions
+    return _topo_positions[key]
+
 
 def sort_commits(repo_dir, commits, branch):
-    """I sort a list of commits based on when they appeared on a branch"""
-    commit_times = {}
-    c = []
+    """I sort a list of commits based on when they appeared on a branch.
+    Commits on the branch are ordered by their topological position on it.
+    Any that aren't on the branch go after those, ordered by commit time
+    and then by sha so that the order never depends on the input order"""
+    unique = []
+    seen = set()
+    for commit in commits:
+        if not commit in seen:
+            seen.add(commit)
+            unique.append(commit)
+    metadata = load_commit_metadata(repo_dir, unique)
+    positions = topo_positions(repo_dir, branch)
+
+    def key(commit):
+        info = metadata[commit]
+        if positions.has_key(info.sha):
+            return (0, positions[info.sha], info.sha)
+        return (1, info.commit_time, info.sha)
+
+    return sorted(unique, key=key)
+
+
+CommitInfo = collections.namedtuple('CommitInfo', [
+    'sha', 'parents', 'commit_time', 'author_name', 'author_email', 'author_date', 'message'])
+
+# Commit metadata never changes for a given sha, so this table is shared
+# by every repository and every caller for the life of the process
+commit_metadata = {}
+
+_metadata_format = "%x00".join(["%H", "%P", "%ct", "%an", "%ae", "%ad", "%B"])
+
+def load_commit_metadata(repo_dir, commits):
+    """Make sure that commit_metadata has an entry for each of commits and
+    return a dictionary of the given commit names to CommitInfo.  Commits
+    that aren't already known are looked up in the commit store and the
+    rest are read with a single 'git log --no-walk --stdin' call"""
+    full = {}
     for commit in commits:
-        if not commit in c:
-            c.append(commit)
-        # This feels a little heavy handed.  If I want this logic to stay, it should
-        # be something that the caller wants
-        #else:
-        #    raise Exception("commit %s is in the list of bugs to sort twice!" % commit)
-    commits = c
-    no_swaps = False
-    while not no_swaps:
-        no_swaps = True
-        for i in range(1, len(commits)):
-            if not a_before_b(repo_dir, branch, commit_times, commits[i-1], commits[i]):
-                tmp = commits[i-1]
-                commits[i-1] = commits[i]
-                commits[i] = tmp
-                no_swaps = False
-    return commits
+        if not full.has_key(commit):
+            # Annotated tags name the tag object, not the commit it tags
+            full[commit] = get_rev(repo_dir, "%s^{commit}" % commit)
+    missing = sorted(set([x for x in full.values() if not commit_metadata.has_key(x)]))
+    if len(missing) > 0:
+        store = commit_store(repo_dir)
+        for sha, row in store.get_commits(missing).items():
+            commit_metadata[sha] = CommitInfo(*row)
+        missing = [x for x in missing if not commit_metadata.has_key(x)]
+    if len(missing) > 0:
+        output = git_op(["log", "--no-walk=unsorted", "--stdin", "-z", "--date=raw",
+                         "--pretty=format:%s" % _metadata_format],
+                        workdir=repo_dir, input="\n".join(missing) + "\n")
+        fields = output.split('\0')
+        loaded = []
+        for i in range(0, len(fields) - len(CommitInfo._fields) + 1, len(CommitInfo._fields)):
+            sha, parents, ct, an, ae, ad, message = fields[i:i + len(CommitInfo._fields)]
+            commit_metadata[sha] = CommitInfo(sha, tuple(parents.split()), int(ct), an, ae, ad, message)
+            loaded.append(commit_metadata[sha])
+        store.put_commits(loaded)
+    return dict([(x, commit_metadata[full[x]]) for x in full.keys()])
+
+
+def commit_info(repo_dir, commit):
+    """Return the CommitInfo for a single commit"""
+    return load_commit_metadata(repo_dir, [commit])[commit]
 
 
 def find_parents(repo_dir, commit):
     """Return a list of commit ids that are parents to 'commit'"""
-    return [x.strip() for x in git_op(["log", "-n1", "--pretty=%P", commit], workdir=repo_dir).split(' ')]
+    return list(commit_info(repo_dir, commit).parents)
+
+
+def _branch_name(ref):
+    if ref.startswith('refs/heads/'):
+        return ref[len('refs/heads/'):]
+    return ref
+
+
+def _tracking_tip(repo_dir, remote, branch):
+    info = object_service(repo_dir).info("refs/remotes/%s/%s" % (remote, branch))
+    return info[0] if info else None
+
+
+def push_preview(repo_dir, remote="origin", branches=[]):
+    """Work out what push would push from the remote-tracking refs instead
+    of asking the remote with a dry run.  Returns the same dictionary as
+    push.  Branches without anything to push are left out.  Raises
+    PushFailure if a branch isn't a fast-forward of its remote-tracking
+    ref"""
+    push_data = {
+        'branches': {},
+        'url': git_op(["remote", "get-url", "--push", remote], workdir=repo_dir).strip()
+    }
+    not_ff = {}
+    for branch in branches:
+        new = get_rev(repo_dir, "refs/heads/%s" % branch)
+        old = _tracking_tip(repo_dir, remote, branch)
+        if old is None or old == new:
+            continue
+        if not is_ancestor(repo_dir, old, new):
+            not_ff[branch] = "not a fast-forward of %s/%s" % (remote, branch)
+        else:
+            push_data['branches'][branch] = (old, new)
+    if len(not_ff) > 0:
+        raise PushFailure("Pushing '%s' to '%s' would be rejected" % ("', '".join(sorted(not_ff)), remote),
+                          rejected=not_ff)
+    return push_data
+
+
+def _parse_push(output):
+    """Split 'git push --porcelain' output into the url and a list of
+    (flag, branch, summary) tuples"""
+    lines = [x for x in output.split('\n') if x.strip() != '']
+    url = None
+    refs = []
+    for line in lines:
+        if line.startswith('To '):
+            url = line[3:].strip()
+        elif line.count('\t') == 2:
+            flag, ref_spec, summary = line.split('\t')
+            refs.append((flag, _branch_name(ref_spec.split(':')[0]), summary))
+    return url, refs, len(lines) > 0 and lines[-1].strip() == 'Done'
 
 
 def push(repo_dir, remote="origin", branches=[], dry_run=True):
-    """ Push code on branches to remote and return a dictionary like:
+    """ Push code on branches to remote with a single atomic push, so either
+    all of them or none of them are updated, and return a dictionary like:
         {'url': 'repo.git',
          'branches': {'master': (first_commit, last_commit),
                       'other': (first_commit, last_commit)
                      }
         }
+    If the remote rejects any branch, the PushFailure lists those branches
+    and why in its rejected attribute
     """
     #(uplifting)jhford-air:~/b2g/uplifting $ git push --porcelain
     #STDERR:Counting objects: 51, done.
@@ -292,40 +1058,54 @@ def push(repo_dir, remote="origin", branches=[], dry_run=True):
     #STDOUT:To git@github.com:jhford/uplift.git
     #STDOUT:	refs/heads/master:refs/heads/master	deb52cd..f46620e
     #STDOUT:Done
-    command = ['push', '--porcelain']
+    command = ['push', '--porcelain', '--atomic']
     if dry_run:
         command.append('--dry-run')
     if remote:
         command.append(remote)
     command += branches
+    # The porcelain output only has abbreviated ids, these are the full ones
+    new_tips = dict([(x, get_rev(repo_dir, "refs/heads/%s" % x)) for x in branches])
+    old_tips = dict([(x, _tracking_tip(repo_dir, remote, x)) for x in branches])
     try:
         output = git_op(command, workdir=repo_dir)
-    except Exception as e:
+    except GitError as e:
+        url, refs, done = _parse_push(e.args[0]['super_exc'].output or '')
+        rejected = dict([(branch, summary) for flag, branch, summary in refs
+                         if flag == '!' and summary != '[rejected] (atomic push failed)'])
         print e
-        raise PushFailure("Failed to run git command '%s' to push" % command)
-    lines = [x for x in output.split('\n') if x.strip() != '']
-    if lines[-1].strip() != 'Done':
+        raise PushFailure("Failed to run git command '%s' to push" % command, rejected=rejected)
+    url, refs, done = _parse_push(output)
+    if not done:
         raise PushFailure("Failed to complete push of '%s' to '%s'" % ("', '".join(branches), remote))
     push_data = {
         'branches':{},
-        'url': lines[0].strip().lstrip('To ')
+        'url': url
     }
-    for push_item in lines[1:-1]:
-        flag, ref_spec, rev_range = push_item.split('\t')
+    for flag, branch, rev_range in refs:
         if flag != ' ':
             continue
-        local_branch, remote_branch = [x.lstrip('refs/heads/') for x in ref_spec.split(':')]
         first_commit, last_commit = rev_range.split('..')
-        first_commit = get_rev(repo_dir, first_commit)
-        last_commit = get_rev(repo_dir, last_commit)
-        push_data['branches'][local_branch] = (first_commit, last_commit)
+        if old_tips.get(branch) and old_tips[branch].startswith(first_commit):
+            first_commit = old_tips[branch]
+        else:
+            first_commit = get_rev(repo_dir, first_commit)
+        if new_tips.get(branch) and new_tips[branch].startswith(last_commit):
+            last_commit = new_tips[branch]
+        else:
+            last_commit = get_rev(repo_dir, last_commit)
+        push_data['branches'][branch] = (first_commit, last_commit)
     return push_data
 
 
+def fetch(repo_dir, remote="origin"):
+    git_op(["fetch", remote], workdir=repo_dir)
+
+
 def recreate_branch(repo_dir, branch, remote="origin"):
-    if branch in branches(repo_dir):
-        git_op(["branch", "-D", branch], workdir=repo_dir)
-    git_op(["checkout", "-t", "%s/%s" % (remote, branch), "-b", branch], workdir=repo_dir)
+    # -B resets the branch if it's already there, so there's nothing to
+    # look up first
+    git_op(["checkout", "-B", branch, "-t", "%s/%s" % (remote, branch)], workdir=repo_dir)
 
 
 def _cache_dir(repo_dir):
@@ -333,20 +1113,218 @@ def _cache_dir(repo_dir):
     return os.path.join(repo_dir_p, ".%s.cache.git" % repo_dir_t)
 
 
-def create_gaia(repo_dir, gaia_url):
+def _worktrees_dir(repo_dir):
+    repo_dir_p, repo_dir_t = os.path.split(os.path.abspath(repo_dir).rstrip(os.sep))
+    return os.path.join(repo_dir_p, ".%s.worktrees" % repo_dir_t)
+
+
+def add_worktree(repo_dir, branch):
+    """Create a worktree attached to repo_dir with branch checked out and
+    return its path.  A branch can only be checked out in one worktree at
+    a time, so it must not be the current branch of repo_dir"""
+    path = os.path.join(_worktrees_dir(repo_dir), branch)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    git_op(["worktree", "prune"], workdir=repo_dir)
+    git_op(["worktree", "add", path, branch], workdir=repo_dir)
+    return path
+
+
+def remove_worktree(repo_dir, path):
+    close_object_services(path)
+    _reachability.pop(os.path.abspath(path), None)
+    _patch_indexes.pop(os.path.abspath(path), None)
+    git_op(["worktree", "remove", "--force", path], workdir=repo_dir)
+
+
+def refresh_gaia(repo_dir, gaia_url):
+    """Bring an existing scratch copy of Gaia into the same state that
+    cloning it again would, without the clone.  Anything left over from an
+    earlier run is thrown away, the remotes are fetched and master and the
+    enabled branches are reset to origin's tips in one ref transaction"""
+    for op in (["cherry-pick", "--abort"], ["merge", "--abort"]):
+        try:
+            git_op(op, workdir=repo_dir)
+        except GitError:
+            pass # Nothing was in progress
+    git_op(["reset", "--hard", "HEAD"], workdir=repo_dir)
+    git_op(["clean", "-fdxq"], workdir=repo_dir)
+    if os.path.exists(_worktrees_dir(repo_dir)):
+        shutil.rmtree(_worktrees_dir(repo_dir))
+    git_op(["worktree", "prune"], workdir=repo_dir)
+    git_op(["remote", "set-url", "origin", gaia_url], workdir=repo_dir)
+    print "Fetching remote references"
+    git_op(["fetch", "--prune", "cache"], workdir=repo_dir)
+    git_op(["fetch", "--prune", "origin"], workdir=repo_dir)
+
+    refs = ref_snapshot(repo_dir)
+    updates = []
+    for branch in c.read_value('repository.enabled_branches') + ['master']:
+        tip = refs.tip("refs/remotes/origin/%s" % branch)
+        if tip is None:
+            raise GitError("origin has no branch '%s'" % branch)
+        updates.append("update refs/heads/%s %s\n" % (branch, tip))
+    # A checked out branch can't be moved safely, so let go of it first
+    checkout(repo_dir, detach=True)
+    git_op(["update-ref", "--stdin"], workdir=repo_dir, input="".join(updates))
+    for branch in c.read_value('repository.enabled_branches') + ['master']:
+        if not refs.has_branch(branch):
+            git_op(["branch", "--set-upstream-to=origin/%s" % branch, branch], workdir=repo_dir)
+    checkout(repo_dir, "master")
+
+
+def _share_objects():
+    try:
+        return c.read_value('repository.share_objects')
+    except KeyError:
+        return False
+
+
+def _partial_clone_filter():
+    try:
+        return c.read_value('repository.partial_clone_filter')
+    except KeyError:
+        return None
+
+
+def is_partial_clone(repo_dir):
+    try:
+        promisors = git_op(["config", "--get-regexp", r"^remote\..*\.promisor$|^extensions\.partialclone$"],
+                           workdir=repo_dir)
+    except GitError:
+        return False # No such settings at all
+    return any(x.split(' ', 1)[1] != 'false' for x in promisors.splitlines() if ' ' in x)
+
+
+def _uses_alternates(repo_dir):
+    return os.path.exists(os.path.join(repo_dir, '.git', 'objects', 'info', 'alternates'))
+
+
+def protect_cache(cache_dir):
+    """A scratch copy cloned with --shared reads its objects from the cache
+    instead of having its own.  If the cache ever deletes an object that
+    is no longer reachable from its own refs, like the old tip of a force
+    pushed branch, the scratch copy is corrupted.  Never prune and never
+    gc automatically in the cache, so that can't happen.  Anything
+    repacking the cache must keep unreachable objects too, so no 'repack
+    -a -d' without -k"""
+    git_op(["config", "gc.pruneExpire", "never"], workdir=cache_dir)
+    git_op(["config", "gc.auto", "0"], workdir=cache_dir)
+
+
+def maintenance_steps(repo_dir):
+    """Return the (name, git command) steps that keep queries fast in
+    repo_dir.  Packs are combined geometrically into a multi-pack-index with
+    a reachability bitmap, so only a few small packs are rewritten each
+    time.  None of these remove unreachable objects, see protect_cache.
+    The commit-graph gets generation numbers and changed-path filters"""
+    if is_partial_clone(repo_dir):
+        # Geometric repacks don't work with promisor packs
+        steps = [("repack", ["repack", "-d", "--write-midx"]),
+                 ("multi-pack-index", ["multi-pack-index", "write", "--bitmap"])]
+    else:
+        steps = [("repack", ["repack", "-d", "--geometric=2", "--write-midx", "--write-bitmap-index"])]
+    steps.append(("commit-graph", ["commit-graph", "write", "--reachable", "--split", "--changed-paths"]))
+    return steps
+
+
+def maintain_repo(repo_dir):
+    """Run every maintenance step in repo_dir, printing how long each one
+    took.  A failing step doesn't stop the others.  Returns a list of
+    (name, seconds, succeeded) tuples"""
+    results = []
+    for name, command in maintenance_steps(repo_dir):
+        start = time.time()
+        try:
+            git_op(command, workdir=repo_dir)
+            succeeded = True
+        except GitError:
+            succeeded = False
+        duration = time.time() - start
+        print "%s %s in %0.2f seconds" % (name, "finished" if succeeded else "FAILED", duration)
+        results.append((name, duration, succeeded))
+    return results
+
+
+# repo_dir -> (pid which started it, background maintenance process)
+_maintenance_procs = {}
+
+def start_maintenance(repo_dir):
+    """Run the maintenance steps in a background process and return it
+    without waiting.  If the last maintenance of repo_dir is still running
+    that process is returned instead of starting another one"""
+    key = os.path.abspath(repo_dir)
+    started = _maintenance_procs.get(key)
+    if started and started[0] == os.getpid() and started[1].poll() is None:
+        return started[1]
+    script = "; ".join(" ".join(pipes.quote(x) for x in [git_bin] + command)
+                       for name, command in maintenance_steps(repo_dir))
+    with open(os.devnull, 'w') as devnull:
+        proc = sp.Popen(["sh", "-c", script], cwd=repo_dir, stdout=devnull, stderr=devnull)
+    _maintenance_procs[key] = (os.getpid(), proc)
+    return proc
+
+
+def reap_maintenance():
+    """Reap the maintenance processes this process started that have
+    finished.  Ones still running are never waited for, once we exit they
+    are reaped by init instead"""
+    for key in _maintenance_procs.keys():
+        pid, proc = _maintenance_procs[key]
+        if pid != os.getpid() or proc.poll() is not None:
+            del _maintenance_procs[key]
+
+atexit.register(reap_maintenance)
+
+
+def _maintain_after_fetch():
+    try:
+        return c.read_value('repository.maintain_after_fetch')
+    except KeyError:
+        return False
+
+
+def create_gaia(repo_dir, gaia_url, refresh=True):
+    """Make sure repo_dir is a clean copy of Gaia with master and the
+    enabled branches at origin's tips.  An existing copy is refreshed in
+    place unless refresh is False, a new one is cloned from the cache"""
     # These two lines are stupid.  They break subtlely when
     # repo_dir isn't an absolute path. 
     repo_dir_p = os.path.split(repo_dir.rstrip(os.sep))[0]
     cache_dir = _cache_dir(os.path.abspath(repo_dir))
 
+    clone_filter = _partial_clone_filter()
+
     # Initialize or update the cached copy of gaia
     if not os.path.isdir(cache_dir):
         print "Initial clone of Gaia cache directory"
-        git_op(["clone", "--mirror", gaia_url, cache_dir],
+        command = ["clone", "--mirror"]
+        if clone_filter:
+            # Only download blobs when something needs them
+            command.append("--filter=%s" % clone_filter)
+        git_op(command + [gaia_url, cache_dir],
                workdir=os.path.split(cache_dir.rstrip(os.sep))[0])
+        if clone_filter:
+            # The scratch copy is cloned from here with the same filter
+            git_op(["config", "uploadpack.allowFilter", "true"], workdir=cache_dir)
+            git_op(["config", "uploadpack.allowAnySHA1InWant", "true"], workdir=cache_dir)
     else:
         print "Fetching updates to Gaia cache directory"
         git_op(["fetch", "--all"], workdir=cache_dir)
+    if _maintain_after_fetch():
+        start_maintenance(cache_dir)
+
+    share_objects = _share_objects()
+    if share_objects or _uses_alternates(repo_dir):
+        protect_cache(cache_dir)
+
+    if refresh and os.path.isdir(os.path.join(repo_dir, '.git')):
+        print "Refreshing Gaia scratch directory"
+        try:
+            refresh_gaia(repo_dir, gaia_url)
+            return
+        except GitError:
+            print "Refreshing Gaia scratch directory failed, creating it again"
 
     # Because we do all of the repository creation locally (i.e. cheaply), we don't
     # really want to risk having bad commits left around, so we delete the repo
@@ -359,9 +1337,25 @@ def create_gaia(repo_dir, gaia_url):
     # references because we want to create a copy of gaia that doesn't need
     # to use the cached copy when pushing changes
     print "Cloning Gaia scratch from cache"
-    git_op(["clone", "file://%s" % cache_dir, repo_dir], workdir=repo_dir_p)
+    partial = clone_filter and not share_objects
+    if share_objects:
+        # Borrow the cache's objects through objects/info/alternates
+        git_op(["clone", "--shared", cache_dir, repo_dir], workdir=repo_dir_p)
+    elif partial:
+        # Checking out needs blobs, which can only come from origin once
+        # it is set up below
+        git_op(["clone", "--no-checkout", "--filter=%s" % clone_filter,
+                "file://%s" % cache_dir, repo_dir], workdir=repo_dir_p)
+    else:
+        git_op(["clone", "file://%s" % cache_dir, repo_dir], workdir=repo_dir_p)
     git_op(["remote", "rename", "origin", "cache"], workdir=repo_dir)
     git_op(["remote", "add", "origin", gaia_url], workdir=repo_dir)
+    if partial:
+        # The cache might not have the blobs either, so missing blobs are
+        # fetched from the real remote.  This also keeps fetching origin
+        # from downloading every new blob
+        git_op(["config", "remote.origin.promisor", "true"], workdir=repo_dir)
+        git_op(["config", "remote.origin.partialclonefilter", clone_filter], workdir=repo_dir)
     print "Fetching remote references"
     git_op(["fetch", "origin"], workdir=repo_dir)
     branches = c.read_value('repository.enabled_branches')
@@ -370,19 +1364,68 @@ def create_gaia(repo_dir, gaia_url):
 
 
 def delete_gaia(repo_dir):
+    close_object_services(repo_dir)
+    _reachability.pop(os.path.abspath(repo_dir), None)
+    _patch_indexes.pop(os.path.abspath(repo_dir), None)
     if os.path.exists(repo_dir):
         shutil.rmtree(repo_dir)
+    if os.path.exists(_worktrees_dir(repo_dir)):
+        shutil.rmtree(_worktrees_dir(repo_dir))
 
 
-def update_gaia(repo_dir, gaia_url):
-    if not os.path.exists(repo_dir):
-        print "Gaia doesn't exist yet"
-    cache_dir = _cache_dir(repo_dir)
-    git_op(["fetch", "--all"], workdir=cache_dir)
-    git_op(["fetch", "cache"], workdir=repo_dir)
+def update_gaia(repo_dir, gaia_url, checkout_branch=None):
+    """Fast-forward master and the enabled branches of an existing scratch
+    copy of Gaia to origin's tips.  Only refs are moved, all in one ref
+    transaction, and the worktree is touched by at most one checkout: of
+    checkout_branch, or of the current branch if it was moved.  Branches
+    that can't be fast-forwarded are left alone and reported.  The return
+    value maps each of them to the reason"""
+    if not os.path.isdir(os.path.join(repo_dir, '.git')):
+        raise GitError("Gaia doesn't exist yet in %s" % repo_dir)
+    cache_dir = _cache_dir(os.path.abspath(repo_dir))
+    if os.path.isdir(cache_dir):
+        git_op(["fetch", "--all"], workdir=cache_dir)
+        git_op(["fetch", "cache"], workdir=repo_dir)
+    git_op(["remote", "set-url", "origin", gaia_url], workdir=repo_dir)
     git_op(["fetch", "origin"], workdir=repo_dir)
-    for branch in branch_logic.branches + ['master']:
-        #recreate_branch(repo_dir, branch, remote="origin")
-        git_op(["reset", "--hard", "HEAD"], workdir=repo_dir)
-        git_op(["checkout", branch], workdir=repo_dir)
-        git_op(["merge", "--ff-only", "%s/%s" % ("origin", branch)], workdir=repo_dir)
+    # Leftovers would be carried into the final checkout
+    git_op(["reset", "--hard", "HEAD"], workdir=repo_dir)
+
+    refs = ref_snapshot(repo_dir)
+    current = refs.current_branch()
+    updates = []
+    moved = []
+    created = []
+    not_updated = {}
+    for branch in c.read_value('repository.enabled_branches') + ['master']:
+        new = refs.tip("refs/remotes/origin/%s" % branch)
+        old = refs.tip(branch)
+        if new is None:
+            not_updated[branch] = "origin has no branch '%s'" % branch
+        elif old is None:
+            updates.append("create refs/heads/%s %s\n" % (branch, new))
+            created.append(branch)
+        elif old == new:
+            continue
+        elif is_ancestor(repo_dir, old, new):
+            # Giving the old value makes the transaction fail rather than
+            # lose a commit if the branch moves under us
+            updates.append("update refs/heads/%s %s %s\n" % (branch, new, old))
+            moved.append(branch)
+        else:
+            not_updated[branch] = "it has commits that origin/%s doesn't" % branch
+
+    if current in moved:
+        # A checked out branch can't be moved safely, so let go of it first
+        checkout(repo_dir, detach=True)
+    if len(updates) > 0:
+        git_op(["update-ref", "--stdin"], workdir=repo_dir, input="".join(updates))
+    for branch in created:
+        git_op(["branch", "--set-upstream-to=origin/%s" % branch, branch], workdir=repo_dir)
+    target = checkout_branch or current
+    if target and (target != current or current in moved):
+        checkout(repo_dir, target)
+
+    for branch in sorted(not_updated.keys()):
+        print "WARNING: could not fast-forward %s: %s" % (branch, not_updated[branch])
+    return not_updated
@@ -0,0 +1,182 @@
+import os
+import json
+import gzip
+import shutil
+import hashlib
+import threading
+import Queue
+import time
+import atexit
+import fcntl
+
+import configuration as c
+
+# These can be overridden in the 'logging' section of the configuration
+defaults = {
+    'max_bytes': 50 * 1024 * 1024, # rotate once the log is this big
+    'max_age': 24 * 60 * 60, # or once its first record is this many seconds old
+    'backups': 5, # number of compressed old logs to keep
+    'output_cap': 64 * 1024, # command output longer than this isn't logged in full
+    'large_output': 'truncate', # either 'truncate' or 'hash'
+}
+
+
+def setting(name):
+    try:
+        return c.read_value('logging.%s' % name)
+    except KeyError:
+        return defaults[name]
+
+
+def _dumps(record):
+    try:
+        return json.dumps(record)
+    except UnicodeDecodeError:
+        # Command output isn't always utf-8, but it's still worth logging
+        return json.dumps(record, encoding='latin-1')
+
+
+class JSONLinesLog(object):
+    """A log file with one JSON object per line.  Records are written by a
+    background thread, so logging never waits for the disk.  The file is
+    gzipped away once it gets too large or too old, keeping only the newest
+    'backups' of them"""
+
+    def __init__(self, filename, max_bytes=None, max_age=None, backups=None,
+                 output_cap=None, large_output=None):
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes if max_bytes is not None else setting('max_bytes')
+        self.max_age = max_age if max_age is not None else setting('max_age')
+        self.backups = backups if backups is not None else setting('backups')
+        self.output_cap = output_cap if output_cap is not None else setting('output_cap')
+        self.large_output = large_output or setting('large_output')
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.started = None
+
+    def cap(self, output):
+        """Return output as it should be logged.  Output over the cap is
+        either truncated or replaced by its hash"""
+        if output is None or len(output) <= self.output_cap:
+            return output
+        if self.large_output == 'hash':
+            return {'sha1': hashlib.sha1(output).hexdigest(), 'bytes': len(output)}
+        return {'truncated': output[:self.output_cap], 'bytes': len(output)}
+
+    def write(self, record):
+        record = dict(record)
+        record.setdefault('time', time.time())
+        if os.getpid() != self.pid:
+            # A forked child, like a parallel uplift worker, can exit without
+            # giving a writer thread the chance to finish, so it writes directly
+            self._write_lines([_dumps(record)])
+            return
+        with self.lock:
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run, name='log writer')
+                self.thread.daemon = True
+                self.thread.start()
+        self.queue.put(record)
+
+    def _run(self):
+        while True:
+            records = [self.queue.get()]
+            # Write everything that's waiting at once
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            done = None in records
+            try:
+                self._write_lines([_dumps(x) for x in records if x is not None])
+            finally:
+                for x in records:
+                    self.queue.task_done()
+            if done:
+                return
+
+    def _first_time(self):
+        try:
+            with open(self.filename) as f:
+                return json.loads(f.readline())['time']
+        except (IOError, ValueError, KeyError, TypeError):
+            return time.time()
+
+    def _write_lines(self, lines):
+        if len(lines) == 0:
+            return
+        # Forked children write and rotate the same file as their parent.
+        # The file itself is renamed away on rotation, so they all lock a
+        # file next to it instead
+        with open(self.filename + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(self.filename):
+                    # Possibly rotated by another process
+                    self.started = None
+                elif self.started is None:
+                    self.started = self._first_time()
+                with open(self.filename, 'ab') as f:
+                    f.write(''.join(x + '\n' for x in lines))
+                if self.started is None:
+                    self.started = time.time()
+                if os.path.getsize(self.filename) >= self.max_bytes or \
+                        time.time() - self.started >= self.max_age:
+                    self.rotate()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _backup(self, n):
+        return '%s.%d.gz' % (self.filename, n)
+
+    def rotate(self):
+        """Compress the current log into filename.1.gz and shift the older
+        backups along"""
+        if not os.path.exists(self.filename):
+            return
+        if os.path.exists(self._backup(self.backups)):
+            os.remove(self._backup(self.backups))
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(self._backup(n)):
+                os.rename(self._backup(n), self._backup(n + 1))
+        if self.backups > 0:
+            with open(self.filename, 'rb') as src:
+                dst = gzip.open(self._backup(1), 'wb')
+                try:
+                    shutil.copyfileobj(src, dst)
+                finally:
+                    dst.close()
+        os.remove(self.filename)
+        self.started = None
+
+    def flush(self):
+        """Wait until everything logged so far is on disk"""
+        if os.getpid() == self.pid and self.thread:
+            self.queue.join()
+
+    def close(self):
+        if os.getpid() == self.pid and self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+_logs = {}
+
+def get_log(filename):
+    """Return the log for filename, all writers of the same file share it"""
+    key = os.path.abspath(filename)
+    if not _logs.has_key(key):
+        _logs[key] = JSONLinesLog(key)
+    return _logs[key]
+
+
+def close_logs():
+    for log in _logs.values():
+        log.close()
+    _logs.clear()
+
+atexit.register(close_logs)
@@ -9,22 +9,23 @@ import branch_logic
 import bzapi
 
 def merge(repo_dir, gaia_url, branch_to, branch_from):
-    git.delete_gaia(repo_dir)
     t=util.time_start()
-    if os.path.exists(repo_dir):
-        print "Updating Gaia"
-        git.update_gaia(repo_dir, gaia_url)
-        print "Updated Gaia in %0.2f seconds" % util.time_end(t)
-    else:
-        print "Creating Gaia"
-        git.create_gaia(repo_dir, gaia_url) # This is sadly broken
-        print "Created Gaia in %0.2f seconds" % util.time_end(t)
+    print "Updating Gaia"
+    git.create_gaia(repo_dir, gaia_url)
+    # Commits left on these branches, like an uplift whose push was declined,
+    # would otherwise be pushed along with the merge
+    refs = git.ref_snapshot(repo_dir)
+    for branch in (branch_to, branch_from):
+        if refs.tip("refs/remotes/origin/%s" % branch):
+            git.recreate_branch(repo_dir, branch, remote="origin")
+    print "Updated Gaia in %0.2f seconds" % util.time_end(t)
 
     print "Merging %s into branch %s" % (branch_from, branch_to)
-    if not branch_to in git.branches(repo_dir):
+    refs = git.ref_snapshot(repo_dir)
+    if not refs.has_branch(branch_to):
         print >> sys.stderr, "Asking to merge into a branch that doesn't exist (%s)" % branch_to
         return None
-    if not branch_from in git.branches(repo_dir):
+    if not refs.has_branch(branch_from):
         print >> sys.stderr, "Asking to merge from a branch that doesn't exist (%s)" % branch_from
         return None
     
@@ -34,9 +35,7 @@ def merge(repo_dir, gaia_url, branch_to, branch_from):
     end_commit = git.get_rev(repo_dir)
     print "Merge range is %s..%s" % (start_commit[:7], end_commit[:7])
     print git.log(repo_dir, "%s..%s" % (start_commit, end_commit), pretty="oneline")
-    print "Dry Run push"
-    git.push(repo_dir, remote="origin", branches=[branch_to], dry_run=True)
-    info = git.push(repo_dir, remote="origin", branches=[branch_to])
+    info = git.push_preview(repo_dir, remote="origin", branches=[branch_to])
     print "Would be pusing to %s" % info['url']
     for branch in info['branches'].keys():
         s,e = info['branches'][branch]
@@ -67,17 +66,17 @@ def guess_bug_id(repo_dir, commit):
             print "%d) Bug %s: %s" % (i, possible_bug_ids[i], bug_summaries.get(possible_bug_ids[i], "Closed bug"))
 
 
-    msg = git.log(repo_dir, commit, number=1, pretty="%B")
+    msg = git.commit_info(repo_dir, commit).message
     bug_ids = []
     possible_bug_ids = []
     bug_summaries = {}
     for pattern in bug_id_patterns:
         possible_bug_ids.extend([int(x) for x in pattern.findall(msg)])
     possible_bug_ids = list(set(sorted(possible_bug_ids)))
+    bug_data = bzapi.fetch_bugs(possible_bug_ids, include_fields="id,summary")
     for bug in possible_bug_ids:
-        bug_data = bzapi.fetch_bug(bug, include_fields="summary")
-        if bug_data.has_key('summary'):
-            bug_summaries[bug] = bug_data['summary']
+        if bug_data.has_key(bug) and bug_data[bug].has_key('summary'):
+            bug_summaries[bug] = bug_data[bug]['summary']
 
     print "Commit %s has a body of:\n%s" % (commit, msg.strip())
     print "-" * 80
@@ -116,7 +115,8 @@ def comment(repo_dir, branch_to, commit_range, dry_run=False):
     comments = {}
     commits_without_bugs = []
 
-    assert branch_to in git.branches(repo_dir), "branch parameter must be a branch"
+    assert git.ref_snapshot(repo_dir).has_branch(branch_to), "branch parameter must be a branch"
+    git.load_commit_metadata(repo_dir, all_commits)
 
     i = 0
     for commit in all_commits:
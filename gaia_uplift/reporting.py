@@ -48,9 +48,11 @@ def display_uplift_requirements(requirements, max_summary=90):
     return t
 
 
-def display_uplift_report(report, max_summary=90):
-    """Generate a PrettyTable that shows the bug id, branch status
-    and first up to 100 chars of the summary"""
+def _commit_table(report, branch_cell):
+    """Generate a PrettyTable that shows the bug id, the master commits,
+    one column per branch and the summary.  branch_cell(bug, commit, branch)
+    returns the text for one master commit on one branch, or None when the
+    bug has nothing to say about it"""
     branches = c.read_value('repository.enabled_branches')
     headers = ['Bug'] + ['%s commit' % x for x in ['master'] + branches] + ['Summary']
     t = pt.PrettyTable(headers, sortby="Bug")
@@ -64,29 +66,52 @@ def display_uplift_report(report, max_summary=90):
         for branch in branches:
             branch_commits = []
             for mcommit in master_commits:
-                if bug.has_key('uplift_status'):
-                    if branch in bug['uplift_status'][mcommit]['success'].keys():
-                        branch_commit = bug['uplift_status'][mcommit]['success'][branch]
-                        if branch_commit == mcommit:
-                            branch_commits.append("+++")
-                        else:
-                            branch_commits.append(branch_commit)
-                    elif branch in bug['uplift_status'][mcommit]['failure']:
-                        branch_commits.append("failed")
-                    else:
-                        branch_commits.append("---")
+                cell = branch_cell(bug, mcommit, branch)
+                if cell is not None:
+                    branch_commits.append(cell)
             if len(branch_commits) == 0:
                 row.append("---")
             else:
-                row.append("\n".join([x[:7] for x in branch_commits]))
+                row.append("\n".join(branch_commits))
 
 
         t.add_row(row + [trim_words(bug['summary'])])
     return t
 
 
+def display_uplift_report(report, max_summary=90):
+    """Generate a PrettyTable that shows the bug id, branch status
+    and first up to 100 chars of the summary"""
+    def branch_cell(bug, mcommit, branch):
+        if not bug.has_key('uplift_status'):
+            return None
+        if branch in bug['uplift_status'][mcommit]['success'].keys():
+            branch_commit = bug['uplift_status'][mcommit]['success'][branch]
+            if branch_commit == mcommit:
+                return "+++"
+            else:
+                return branch_commit[:7]
+        elif branch in bug['uplift_status'][mcommit]['failure']:
+            return "failed"
+        else:
+            return "---"
+    return _commit_table(report, branch_cell)
+
+
+def display_prediction(prediction, max_summary=90):
+    """Generate a PrettyTable in the same layout as display_uplift_report
+    which shows whether each commit is predicted to pick cleanly,
+    conflict, already be present or not be pickable at all on each branch"""
+    labels = {'clean': 'clean', 'conflict': 'CONFLICT', 'present': '+++', 'invalid': 'INVALID'}
+    def branch_cell(bug, mcommit, branch):
+        if not bug.has_key('prediction'):
+            return None
+        return labels.get(bug['prediction'][mcommit].get(branch), "---")
+    return _commit_table(prediction, branch_cell)
+
+
 def merge_script(repo_dir, commit, branches):
-    full_commit = git.get_rev(repo_dir, commit)
+    full_commit = git.commit_info(repo_dir, commit).sha
     s=["  git checkout %s" % branches[0]]
     master_num = git.determine_cherry_pick_master_number(repo_dir, commit, 'master')
     if not master_num:
@@ -251,6 +276,9 @@ def comment(repo_dir, report):
         del report[bug_id]
         util.write_json(uplift.uplift_report_file, report)
 
+    # Every comment needs the current version of its bug
+    bzapi.revalidate_bugs(good + bad + ugly)
+
     for i, j in (good, good_bug_comment), (bad, bad_bug_comment), (ugly, ugly_bug_comment):
         for bug_id in i:
             print "Commenting on bug %s" % bug_id
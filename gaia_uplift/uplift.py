@@ -6,6 +6,7 @@ import sys
 import copy
 import json
 import time
+import multiprocessing
 
 import prettytable as pt
 
@@ -27,8 +28,15 @@ push_info_file = os.path.abspath("uplift_info_%s.json" % util.time_str())
 skip_bugs_file = os.path.abspath("skip_bugs.json")
 
 
-def find_bugs(queries):
+def find_bugs(queries, include_fields=None):
+    """Run the Bugzilla searches and return the bugs they find that aren't
+    skipped.  These are bug ids, or dictionaries of include_fields when
+    that is given"""
+    def _id(bug):
+        return bug['id'] if include_fields else bug
+
     bug_data = []
+    found = set()
     all_queries = []
     for q in queries:
         all_queries.extend(bzapi.parse_bugzilla_query(q))
@@ -36,13 +44,17 @@ def find_bugs(queries):
     for q in all_queries:
         sys.stdout.write('.')
         sys.stdout.flush()
-        search_data = bzapi.search(q)
+        if include_fields:
+            search_data = bzapi.search(q, include_fields)
+        else:
+            search_data = bzapi.search(q)
         for bug in search_data:
-            if not bug in bug_data:
+            if not _id(bug) in found:
+                found.add(_id(bug))
                 bug_data.append(bug)
     sys.stdout.write('\nFinished running searches\n')
     sys.stdout.flush()
-    return [x for x in bug_data if not is_skipable(x)]
+    return [x for x in bug_data if not is_skipable(_id(x))]
 
 
 def order_commits(repo_dir, requirements):
@@ -53,18 +65,25 @@ def order_commits(repo_dir, requirements):
     return git.sort_commits(repo_dir, commits, "master")
 
 
-def uplift_commit(repo_dir, commit, to_branches, from_branch="master"):
+def _pick(repo_dir, commit, branch, from_branch, in_memory=False):
+    """Cherry-pick one commit and return the new commit, the original
+    commit if the branch already had it or None if it failed.  The
+    in_memory picks only create objects and never touch a worktree"""
+    cherry_pick = git.cherry_pick_objects if in_memory else git.cherry_pick
+    try:
+        return cherry_pick(repo_dir, commit, branch, from_branch)
+    except git.GitNoop:
+        # TODO: Do something smarter here
+        return commit
+    except git.GitError:
+        return None
+
+
+def uplift_commit(repo_dir, commit, to_branches, from_branch="master", in_memory=False):
     uplift_info = {'success': {},
                    'failure': []}
     for branch in to_branches:
-        try:
-            new_rev = git.cherry_pick(repo_dir, commit, branch, from_branch)
-        except git.GitNoop:
-            # TODO: Do something smarter here
-            new_rev = commit
-        except git.GitError:
-            new_rev = None
-
+        new_rev = _pick(repo_dir, commit, branch, from_branch, in_memory)
         if new_rev:
             uplift_info['success'][branch] = new_rev
         else:
@@ -72,7 +91,234 @@ def uplift_commit(repo_dir, commit, to_branches, from_branch="master"):
     return uplift_info
 
 
-def uplift(repo_dir, gaia_url, requirements):
+def uplift_branch(repo_dir, branch, commits, from_branch="master", in_memory=False):
+    """Cherry-pick an ordered list of commits onto a single branch.  Returns
+    a dictionary of commit to new commit, or None for failed commits"""
+    return dict([(commit, _pick(repo_dir, commit, branch, from_branch, in_memory))
+                 for commit in commits])
+
+
+def _pick_batch(repo_dir, branch, commits, master_num, results):
+    """Cherry-pick commits onto branch in one sequence.  If that fails, the
+    list is split in half and each half is tried on its own until the
+    commits that fail are isolated"""
+    try:
+        results.update(zip(commits, git.cherry_pick_sequence(repo_dir, commits, branch, master_num)))
+    except git.GitError:
+        if len(commits) == 1:
+            results[commits[0]] = None
+        else:
+            half = len(commits) / 2
+            _pick_batch(repo_dir, branch, commits[:half], master_num, results)
+            _pick_batch(repo_dir, branch, commits[half:], master_num, results)
+
+
+def _shares_run(run_master_num, master_num):
+    """Can a commit picked with master_num join a run of commits picked
+    with run_master_num?  None is a non-merge commit or a run of them"""
+    if master_num is None:
+        return run_master_num in (None, "-m1")
+    if run_master_num is None:
+        # The run so far is all non-merge commits
+        return master_num == "-m1"
+    return run_master_num == master_num
+
+
+def uplift_branch_batch(repo_dir, branch, commits, from_branch="master"):
+    """Like uplift_branch, but try to cherry-pick all of the commits with a
+    single cherry-pick command.  Only when there is a failure are the
+    commits bisected to find the ones that don't apply"""
+    results = {}
+    to_pick = []
+    for commit in commits:
+        try:
+            git.check_pickable(repo_dir, commit, branch, from_branch)
+            to_pick.append(commit)
+        except git.GitNoop:
+            results[commit] = commit
+        except git.GitError:
+            results[commit] = None
+
+    # A cherry-pick sequence can only use one -m value.  Non-merge commits
+    # accept -m1 but refuse any other parent number, so they only share a
+    # sequence with merges that are picked with -m1
+    runs = []
+    for commit in to_pick:
+        master_num = git.determine_cherry_pick_master_number(repo_dir, commit, from_branch)
+        if len(runs) > 0 and _shares_run(runs[-1][0], master_num):
+            runs[-1][1].append(commit)
+            if master_num:
+                runs[-1][0] = master_num
+        else:
+            runs.append([master_num, [commit]])
+    for master_num, run in runs:
+        _pick_batch(repo_dir, branch, run, master_num, results)
+    return results
+
+
+def _uplift_branch_worker(args):
+    repo_dir, branch, commits, in_memory, batch = args
+    if batch:
+        return branch, uplift_branch_batch(repo_dir, branch, commits)
+    return branch, uplift_branch(repo_dir, branch, commits, in_memory=in_memory)
+
+
+def commit_statuses(ordered_commits, needed_on, branch_results):
+    """Turn per-branch results from uplift_branch into the per-commit
+    success and failure records that uplift_commit returns"""
+    statuses = {}
+    for commit in ordered_commits:
+        uplift_info = {'success': {},
+                       'failure': []}
+        for branch in needed_on[commit]:
+            new_rev = branch_results.get(branch, {}).get(commit)
+            if new_rev:
+                uplift_info['success'][branch] = new_rev
+            else:
+                uplift_info['failure'].append(branch)
+        statuses[commit] = uplift_info
+    return statuses
+
+
+def _branch_commits(ordered_commits, needed_on):
+    """Return a dictionary of branch to the ordered commits it needs"""
+    branch_commits = {}
+    for commit in ordered_commits:
+        for branch in needed_on[commit]:
+            branch_commits.setdefault(branch, []).append(commit)
+    return branch_commits
+
+
+def uplift_parallel(repo_dir, ordered_commits, needed_on, in_memory=False, batch=False):
+    """Uplift every branch at the same time.  Each branch's commits are
+    cherry-picked in a separate process.  Branches get their own worktree
+    attached to repo_dir, so no worktree has to switch between branches,
+    unless the picks are done in_memory and need no worktree at all"""
+    in_memory = in_memory and not batch
+    branch_commits = _branch_commits(ordered_commits, needed_on)
+    if len(branch_commits) == 0:
+        return commit_statuses(ordered_commits, needed_on, {})
+
+    # The branches can't be checked out here while they are in a worktree
+    original_branch = git.current_branch(repo_dir)
+    if not in_memory:
+        git.checkout(repo_dir, "HEAD", detach=True)
+    worktrees = {}
+    try:
+        for branch in branch_commits.keys():
+            worktrees[branch] = repo_dir if in_memory else git.add_worktree(repo_dir, branch)
+        print "Uplifting %s in parallel" % util.e_join(sorted(branch_commits.keys()))
+        pool = multiprocessing.Pool(min(len(branch_commits), multiprocessing.cpu_count()))
+        try:
+            branch_results = dict(pool.map(_uplift_branch_worker,
+                [(worktrees[x], x, branch_commits[x], in_memory, batch) for x in branch_commits.keys()]))
+        finally:
+            pool.close()
+            pool.join()
+            # The workers moved the branches, which this process can't see
+            git.invalidate_refs()
+    finally:
+        if not in_memory:
+            for branch in worktrees.keys():
+                git.remove_worktree(repo_dir, worktrees[branch])
+            if original_branch:
+                git.checkout(repo_dir, original_branch)
+    for branch in sorted(branch_results.keys()):
+        failed = [x for x in branch_commits[branch] if not branch_results[branch][x]]
+        print "%s: %d of %d commits uplifted" % (
+            branch, len(branch_commits[branch]) - len(failed), len(branch_commits[branch]))
+    return commit_statuses(ordered_commits, needed_on, branch_results)
+
+
+def predict_branch(repo_dir, branch, commits, from_branch="master"):
+    """Simulate cherry-picking an ordered list of commits onto branch
+    without changing anything.  Each commit is picked in memory on top of
+    the branch tip plus the earlier clean picks.  Returns a dictionary of
+    commit to 'clean', 'conflict', 'present' or 'invalid', which is for
+    commits that can't be cherry-picked at all, like ones not on from_branch"""
+    tip = git.get_rev(repo_dir, "refs/heads/%s" % branch)
+    outcomes = {}
+    for commit in commits:
+        try:
+            git.check_pickable(repo_dir, commit, branch, from_branch)
+        except git.GitNoop:
+            outcomes[commit] = 'present'
+            continue
+        except git.GitError:
+            # The real uplift refuses these, there's no conflict to look for
+            outcomes[commit] = 'invalid'
+            continue
+        try:
+            tip = git.pick_commit_objects(repo_dir, commit, tip, from_branch)
+            outcomes[commit] = 'clean'
+        except git.GitNoop:
+            # An empty pick means the branch already has the change
+            outcomes[commit] = 'present'
+        except git.GitError:
+            outcomes[commit] = 'conflict'
+    return outcomes
+
+
+def _predict_branch_worker(args):
+    repo_dir, branch, commits = args
+    return branch, predict_branch(repo_dir, branch, commits)
+
+
+def _with_commits(requirements):
+    with_commits = {}
+    for bug_id in requirements.keys():
+        if requirements[bug_id].has_key('commits'):
+            with_commits[bug_id] = requirements[bug_id]
+    return with_commits
+
+
+def _needed_on(with_commits, ordered_commits):
+    """Return a dictionary of commit to the branches that need it"""
+    needed_on = {}
+    for commit in ordered_commits:
+        needed_on[commit] = []
+        for bug_id in with_commits.keys():
+            if commit in with_commits[bug_id]['commits']:
+                for i in with_commits[bug_id]['needed_on']:
+                    if not i in needed_on[commit]:
+                        needed_on[commit].append(i)
+    return needed_on
+
+
+def predict(repo_dir, gaia_url, requirements):
+    """Predict the outcome of uplifting requirements without touching any
+    branch.  The branches are simulated at the same time in a process
+    pool.  Returns a copy of the bugs with commits where each bug has a
+    'prediction' of commit to branch to outcome"""
+    t=util.time_start()
+    print "Updating Gaia"
+    git.create_gaia(repo_dir, gaia_url)
+    print "Created Gaia in %0.2f seconds" % util.time_end(t)
+
+    with_commits = _with_commits(requirements)
+    ordered_commits = order_commits(repo_dir, with_commits)
+    needed_on = _needed_on(with_commits, ordered_commits)
+    branch_commits = _branch_commits(ordered_commits, needed_on)
+
+    branch_outcomes = {}
+    if len(branch_commits) > 0:
+        pool = multiprocessing.Pool(min(len(branch_commits), multiprocessing.cpu_count()))
+        try:
+            branch_outcomes = dict(pool.map(_predict_branch_worker,
+                [(repo_dir, x, branch_commits[x]) for x in branch_commits.keys()]))
+        finally:
+            pool.close()
+            pool.join()
+
+    prediction = copy.deepcopy(with_commits)
+    for bug_id in prediction.keys():
+        p = prediction[bug_id]['prediction'] = {}
+        for commit in prediction[bug_id]['commits']:
+            p[commit] = dict([(x, branch_outcomes[x][commit]) for x in needed_on.get(commit, [])])
+    return prediction
+
+
+def uplift(repo_dir, gaia_url, requirements, parallel=False, in_memory=False, batch=False):
     # Setup stuff
     t=util.time_start()
     print "Updating Gaia"
@@ -80,30 +326,40 @@ def uplift(repo_dir, gaia_url, requirements):
     print "Created Gaia in %0.2f seconds" % util.time_end(t)
 
     # Determining what needs to be uplifted
-    with_commits = {}
-    for bug_id in requirements.keys():
-        if requirements[bug_id].has_key('commits'):
-            with_commits[bug_id] = requirements[bug_id]
+    with_commits = _with_commits(requirements)
 
     ordered_commits = order_commits(repo_dir, with_commits)
 
     uplift = dict([(x, {}) for x in ordered_commits])
 
-    # Uplifting
+    needed_on = _needed_on(with_commits, ordered_commits)
     for commit in ordered_commits:
-        needed_on = []
-        for bug_id in with_commits.keys():
-            if commit in with_commits[bug_id]['commits']:
-                for i in with_commits[bug_id]['needed_on']:
-                    if not i in needed_on:
-                        needed_on.append(i)
-        print "\n", "="*80
-        print "Attempting to uplift %s commit to %s" % (commit, util.e_join(needed_on))
-        uplift[commit]['needed_on'] = needed_on
-        result = uplift_commit(repo_dir, commit, needed_on)
-        print "Sucess on %s" % util.e_join(result['success'].keys())
-        print "Failure on %s" % util.e_join(result['failure'])
-        uplift[commit]['uplift_status'] = result
+        uplift[commit]['needed_on'] = needed_on[commit]
+
+    # Uplifting
+    if parallel:
+        statuses = uplift_parallel(repo_dir, ordered_commits, needed_on,
+                                   in_memory=in_memory, batch=batch)
+        for commit in ordered_commits:
+            uplift[commit]['uplift_status'] = statuses[commit]
+    elif batch:
+        branch_commits = _branch_commits(ordered_commits, needed_on)
+        branch_results = {}
+        for branch in sorted(branch_commits.keys()):
+            print "Uplifting %d commits to %s" % (len(branch_commits[branch]), branch)
+            branch_results[branch] = uplift_branch_batch(repo_dir, branch, branch_commits[branch])
+        statuses = commit_statuses(ordered_commits, needed_on, branch_results)
+        for commit in ordered_commits:
+            uplift[commit]['uplift_status'] = statuses[commit]
+    else:
+        for commit in ordered_commits:
+            needed_on = uplift[commit]['needed_on']
+            print "\n", "="*80
+            print "Attempting to uplift %s commit to %s" % (commit, util.e_join(needed_on))
+            result = uplift_commit(repo_dir, commit, needed_on, in_memory=in_memory)
+            print "Sucess on %s" % util.e_join(result['success'].keys())
+            print "Failure on %s" % util.e_join(result['failure'])
+            uplift[commit]['uplift_status'] = result
 
     uplift_report = copy.deepcopy(with_commits)
 
@@ -161,21 +417,17 @@ def build_uplift_requirements(repo_dir):
         for branch in enabled_branches:
             queries.extend(all_queries[branch])
 
-        bugs = [x for x in find_bugs(queries) if not is_skipable(x)]
-        print "Fetching bug data"
-        for bug_id in bugs:
-            if is_skipable(bug_id):
-                continue
-            bug = bzapi.fetch_complete_bug(bug_id)
-            print "+",
+        # The searches return everything the branch rules need, comments
+        # are only fetched for the bugs that get to find_commits
+        bugs = find_bugs(queries, include_fields=branch_logic.rule_fields())
+        for bug in bugs:
             needed_on = branch_logic.needed_on_branches(bug)
             if len(needed_on) == 0:
                 continue
-            b = bug_info[bug_id] = {}
+            b = bug_info[bug['id']] = {}
             b['needed_on'] = needed_on
             b['already_fixed_on'] = branch_logic.fixed_on_branches(bug)
             b['summary'] = bug['summary']
-        print "\nFinished fetching bug data"
         util.write_json(requirements_file, bug_info)
     return bug_info
 
@@ -186,20 +438,28 @@ def _display_push_info(push_info):
         print "  * %s: %s..%s" % (branch, start[:7], end[:7])
 
 
-def push(repo_dir):
+def push(repo_dir, remote="origin"):
     branches = c.read_value('repository.enabled_branches')
-    preview_push_info = git.push(repo_dir, remote="origin", branches=branches, dry_run=True)
+    preview_push_info = git.push_preview(repo_dir, remote=remote, branches=branches)
     print "If you push, you'd be pushing: "
     _display_push_info(preview_push_info)
     if not util.ask_yn('Do you wish to push?'):
         return None
     for i in range(5):
         try:
-            rv = git.push(repo_dir, remote="origin", branches=branches, dry_run=False)
+            rv = git.push(repo_dir, remote=remote, branches=branches, dry_run=False)
             util.write_json(push_info_file, rv)
             print "Push attempt %d worked" % int(i+1)
             return rv
-        except:
+        except git.PushFailure, e:
             print "Push attempt %d failed" % int(i+1)
+            if len(e.rejected) > 0:
+                # The push is atomic, so nothing was pushed.  Trying the same
+                # push again won't help, but the new remote tips will
+                git.fetch(repo_dir, remote)
+                print "The remote rejected:"
+                for branch in sorted(e.rejected.keys()):
+                    print "  * %s: %s" % (branch, e.rejected[branch])
+                raise
     raise git.PushFailure("remote %s branches %s" % (remote, util.e_join(branches)))
 
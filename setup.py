@@ -10,8 +10,7 @@ setup(
             'uplift = gaia_uplift.driver:main'
         ]
     },
-    install_requires = ["isodate",
-                        "requests",
+    install_requires = ["requests",
                         "PrettyTable"],
     tests_require = ["nose",
                      "mock",
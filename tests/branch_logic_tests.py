@@ -31,6 +31,16 @@ class TestFlagsToSet(BranchLogicTests):
                                  'v2-status': 'fixed'})
 
 
+class TestRuleFields(BranchLogicTests):
+    def test_rule_fields(self):
+        fields = subject.rule_fields().split(',')
+        for field in ('id', 'summary', 'attachments', c.read_value('rules.blocking_flag')):
+            self.assertTrue(field in fields)
+        for flag in c.read_value('rules.status_flags').values():
+            self.assertTrue(flag in fields)
+        self.assertEqual(sorted(set(fields)), fields)
+
+
 class TestFixedOnBranches(BranchLogicTests):
     def test_fixed_on_no_branches_blocking(self):
         bug = u.make_bug({'blocking': 'v2'})
@@ -2,6 +2,7 @@ import unittest
 import os
 import gaia_uplift.bugdb as subject
 import time
+import threading
 
 local_pickle_file = 'test.pickle'
 if os.path.exists(local_pickle_file):
@@ -81,6 +82,11 @@ class Store(BugDbTest):
         with self.assertRaises(ValueError):
             subject.store({'id': 'bannana'})
 
+    def test_store_many(self):
+        subject.store_many([{'id': 1233, 'data': 'otherjohn'}, {'id': '1234', 'data': 'john'}])
+        subject.init()
+        self.assertEqual([1233, 1234], sorted(subject.bug_db['bugs'].keys()))
+
 class Load(BugDbTest):
     def setUp(self):
         subject.store({
@@ -96,6 +102,16 @@ class Load(BugDbTest):
         bug = subject.load(1111)
         self.assertTrue(bug is None)
 
+    def test_load_waits_for_lock(self):
+        loaded = []
+        thread = threading.Thread(target=lambda: loaded.append(subject.load(1234)))
+        with subject._lock:
+            thread.start()
+            thread.join(0.2)
+            self.assertEqual([], loaded)
+        thread.join()
+        self.assertEqual('john', loaded[0]['data'])
+
 class LastMod(BugDbTest):
     def test_bug_is_there(self):
         test_bug = {
@@ -108,6 +124,17 @@ class LastMod(BugDbTest):
     def test_bug_is_absent(self):
         self.assertTrue(subject.last_mod(1111) is None)
 
+    def test_last_mod_waits_for_lock(self):
+        subject.store({'id': 1234, 'last_change_time': 'john'})
+        found = []
+        thread = threading.Thread(target=lambda: found.append(subject.last_mod(1234)))
+        with subject._lock:
+            thread.start()
+            thread.join(0.2)
+            self.assertEqual([], found)
+        thread.join()
+        self.assertEqual(['john'], found)
+
     def test_bug_absent_db_exists(self):
         subject.store({'id': 1235})
         self.assertTrue(subject.last_mod(1111) is None)
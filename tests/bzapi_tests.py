@@ -1,6 +1,7 @@
 import unittest
 import os
 import copy
+import json
 import gaia_uplift.bzapi as subject
 import gaia_uplift.configuration as c
 from mock import patch
@@ -120,6 +121,164 @@ class CreateUpdates(BZAPITest):
         }
         self.assertEqual(expected, updates)
 
+class UpdateBug(BZAPITest):
+    def test_token_not_from_cache(self):
+        def query(url, method='get', retry=False, **kwargs):
+            if method == 'get':
+                return {'id': 1, 'update_token': 'current'}
+            return {}
+        with patch('gaia_uplift.bugdb.load') as load, \
+             patch('gaia_uplift.bzapi.do_query') as do_query:
+            load.return_value = {'id': 1, 'update_token': 'stale'}
+            do_query.side_effect = query
+            subject.update_bug(1, comment='hello')
+            self.assertFalse(load.called)
+            self.assertEqual(2, do_query.call_count)
+            get_url = do_query.call_args_list[0][0][0]
+            self.assertIn('bug/1?', get_url)
+            self.assertIn('update_token', get_url)
+            put = do_query.call_args_list[1]
+            self.assertEqual('put', put[0][1])
+            self.assertEqual({'token': 'current', 'comments': [{'text': 'hello'}]},
+                             json.loads(put[1]['data']))
+
+
+class RateLimiter(unittest.TestCase):
+    def test_spacing(self):
+        limiter = subject.RateLimiter(2)
+        with patch('time.time') as now, patch('time.sleep') as sleep:
+            now.return_value = 100.0
+            limiter.wait()
+            self.assertFalse(sleep.called)
+            limiter.wait()
+            sleep.assert_called_once_with(0.5)
+            limiter.wait()
+            self.assertEqual(1.0, sleep.call_args[0][0])
+
+    def test_unlimited(self):
+        limiter = subject.RateLimiter(0)
+        with patch('time.sleep') as sleep:
+            for i in range(0, 5):
+                limiter.wait()
+            self.assertFalse(sleep.called)
+
+
+class FetchBugs(BZAPITest):
+    def test_chunks_fit_in_urls(self):
+        query = {'include_fields': 'id'}
+        bug_ids = range(100000, 103000)
+        chunks = subject._bug_id_chunks(bug_ids, query)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(bug_ids, sum(chunks, []))
+        for chunk in chunks:
+            url = subject.compute_url(dict(query, id=','.join(str(x) for x in chunk)), 'bug')
+            self.assertTrue(len(url) <= subject.max_url_length)
+
+    def test_fetch_bugs(self):
+        def query(url, retry=False):
+            ids = subject.parse_bzapi_url(url)['id'].split(',')
+            # The server leaves out bugs that can't be seen
+            return {'bugs': [{'id': int(x), 'summary': x} for x in ids if x != '3']}
+        with patch('gaia_uplift.bzapi.do_query') as do_query, \
+             patch('gaia_uplift.bugdb.store_many') as store_many:
+            do_query.side_effect = query
+            bugs = subject.fetch_bugs(['1', 2, 3, 2], include_fields='id,summary')
+            self.assertEqual(1, do_query.call_count)
+            self.assertEqual({1: {'id': 1, 'summary': '1'}, 2: {'id': 2, 'summary': '2'}}, bugs)
+            self.assertFalse(store_many.called)
+            subject.fetch_bugs([1])
+            self.assertEqual([{'id': 1, 'summary': '1'}], store_many.call_args[0][0])
+
+    def test_fetch_no_bugs(self):
+        with patch('gaia_uplift.bzapi.do_query') as do_query:
+            self.assertEqual({}, subject.fetch_bugs([]))
+            self.assertFalse(do_query.called)
+
+
+class Search(BZAPITest):
+    def test_ids(self):
+        with patch('gaia_uplift.bzapi.do_query') as do_query:
+            do_query.return_value = {'bugs': [{'id': 1}, {'id': 2}]}
+            self.assertEqual([1, 2], subject.search({'a': 'b'}))
+            self.assertFalse('include_fields' in subject.parse_bzapi_url(do_query.call_args[0][0]))
+
+    def test_include_fields(self):
+        with patch('gaia_uplift.bzapi.do_query') as do_query:
+            do_query.return_value = {'bugs': [{'id': 1, 'summary': 'one'}]}
+            self.assertEqual([{'id': 1, 'summary': 'one'}],
+                             subject.search({'a': 'b'}, 'id,summary'))
+            query = subject.parse_bzapi_url(do_query.call_args[0][0])
+            self.assertEqual('id,summary', query['include_fields'])
+            self.assertEqual('b', query['a'])
+
+
+class BugCache(BZAPITest):
+    def setUp(self):
+        BZAPITest.setUp(self)
+        self.forget()
+        self.cache = {
+            1: {'id': 1, 'last_change_time': '2014-01-01T00:00:00Z', 'summary': 'old'},
+            2: {'id': 2, 'last_change_time': '2014-01-01T00:00:00Z', 'summary': 'old'},
+        }
+
+    def tearDown(self):
+        self.forget()
+        BZAPITest.tearDown(self)
+
+    def forget(self):
+        subject._cache_hits.clear()
+        subject._cache_misses.clear()
+        subject._fresh.clear()
+
+    def test_unchanged_bug_not_refetched(self):
+        with patch('gaia_uplift.bugdb.load') as load, \
+             patch('gaia_uplift.bugdb.store') as store, \
+             patch('gaia_uplift.bzapi._fetch_bug') as fetch_bug:
+            load.side_effect = self.cache.get
+            fetch_bug.return_value = {'id': 1, 'last_change_time': '2014-01-01T00:00:00Z'}
+            self.assertEqual(self.cache[1], subject.fetch_complete_bug(1))
+            fetch_bug.assert_called_once_with(1, False)
+            # Once it's known to be current, the server isn't asked again
+            self.assertEqual(self.cache[1], subject.fetch_complete_bug(1))
+            self.assertEqual(1, fetch_bug.call_count)
+            self.assertFalse(store.called)
+        self.assertEqual("Bug cache: 1 bugs used from the cache, 0 fetched", subject.cache_report())
+
+    def test_changed_bug_refetched(self):
+        new_bug = {'id': 1, 'last_change_time': '2014-02-01T00:00:00Z', 'summary': 'new'}
+        def fetch(bug_id, all_fields):
+            if all_fields:
+                return new_bug
+            return {'id': 1, 'last_change_time': new_bug['last_change_time']}
+        with patch('gaia_uplift.bugdb.load') as load, \
+             patch('gaia_uplift.bugdb.store') as store, \
+             patch('gaia_uplift.bzapi._fetch_bug') as fetch_bug:
+            load.side_effect = self.cache.get
+            fetch_bug.side_effect = fetch
+            self.assertEqual(new_bug, subject.fetch_complete_bug(1))
+            store.assert_called_once_with(new_bug)
+        self.assertEqual("Bug cache: 0 bugs used from the cache, 1 fetched", subject.cache_report())
+
+    def test_revalidate_bugs(self):
+        def fetch_bugs(bug_ids, include_fields=subject.complete_fields):
+            if include_fields == subject.complete_fields:
+                return dict((x, {'id': x}) for x in bug_ids)
+            return {1: {'id': 1, 'last_change_time': '2014-01-01T00:00:00Z'},
+                    2: {'id': 2, 'last_change_time': '2014-02-01T00:00:00Z'}}
+        with patch('gaia_uplift.bugdb.load') as load, \
+             patch('gaia_uplift.bzapi.fetch_bugs') as fetch_bugs_mock:
+            load.side_effect = self.cache.get
+            fetch_bugs_mock.side_effect = fetch_bugs
+            subject.revalidate_bugs(['1', 2, 3])
+            self.assertEqual(2, fetch_bugs_mock.call_count)
+            self.assertEqual([1, 2], sorted(fetch_bugs_mock.call_args_list[0][0][0]))
+            self.assertEqual([2, 3], fetch_bugs_mock.call_args_list[1][0][0])
+            self.assertTrue(subject._is_fresh(1))
+
+    def test_no_report(self):
+        self.assertEqual(None, subject.cache_report())
+
+
 class RawQuery(unittest.TestCase):
     def setUp(self):
         subject.credentials = subject.load_credentials(os.path.abspath(os.path.join(os.path.dirname(__file__), 'test_cred')))
@@ -132,7 +291,7 @@ class RawQuery(unittest.TestCase):
             def json(self):
                 return {'hello': 'hi'}
 
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value = SuccessResponse()
 
             actual = subject._raw_query('get', 'http://www.google.com/')
@@ -140,7 +299,7 @@ class RawQuery(unittest.TestCase):
             self.assertEqual(expected, actual)
 
     def test_request_fails(self):
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.side_effect = requests.exceptions.RequestException
             with self.assertRaises(subject.FailedBZAPICall):
                 subject._raw_query('get', 'http://www.google.com/')
@@ -150,7 +309,7 @@ class RawQuery(unittest.TestCase):
             status_code = 200
             def json(self):
                 raise ValueError
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value = BadJson()
             with self.assertRaises(subject.FailedBZAPICall):
                 subject._raw_query('get', 'http://www.google.com/')
@@ -160,7 +319,7 @@ class RawQuery(unittest.TestCase):
             status_code = 200
             def json(self):
                 return {'error': 1, 'message': 'fake error'}
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value = ApiError()
             with self.assertRaises(subject.FailedBZAPICall):
                 subject._raw_query('get', 'http://www.google.com/')
@@ -178,8 +337,25 @@ class RawQuery(unittest.TestCase):
                     'a bad code',
                     {},
                     None)
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value = BadStatus()
             with self.assertRaises(subject.FailedBZAPICall):
                 subject._raw_query('get', 'http://www.google.com/')
-    
+
+    def test_timeout(self):
+        class SuccessResponse():
+            status_code = 200
+            def json(self):
+                return {}
+        with patch('requests.Session.request') as request:
+            request.return_value = SuccessResponse()
+            subject._raw_query('get', 'http://www.google.com/')
+            self.assertEqual(subject.defaults['timeout'], request.call_args[1]['timeout'])
+            subject._raw_query('get', 'http://www.google.com/', timeout=5)
+            self.assertEqual(5, request.call_args[1]['timeout'])
+
+    def test_shared_session(self):
+        session = subject.session()
+        self.assertIs(session, subject.session())
+        self.assertEqual(subject.defaults['pool_size'],
+                         session.get_adapter('https://example.com/')._pool_maxsize)
@@ -0,0 +1,69 @@
+import unittest
+import tempfile
+import shutil
+import os
+import threading
+
+import gaia_uplift.commitdb as subject
+
+
+class CommitStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp(prefix='.scratch_', dir='.')
+        self.store = subject.CommitStore(os.path.join(self.scratch, 'commits.sqlite'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.scratch)
+
+    def test_commits(self):
+        row = ('a' * 40, ('b' * 40, 'c' * 40), 1000000000, 'John \xff', 'john@example.com',
+               '1000000000 +0000', 'message\n')
+        self.store.put_commits([row])
+        self.assertEqual({'a' * 40: row}, self.store.get_commits(['a' * 40, 'd' * 40]))
+        self.assertEqual({}, self.store.get_commits(['d' * 40]))
+
+    def test_many_commits(self):
+        rows = [('%040x' % i, (), i, 'a', 'b', 'c', 'd') for i in range(0, 2000)]
+        self.store.put_commits(rows)
+        self.assertEqual(2000, len(self.store.get_commits([x[0] for x in rows])))
+
+    def test_ancestry(self):
+        self.assertEqual(None, self.store.get_ancestry('a' * 40, 'b' * 40))
+        self.store.put_ancestry('a' * 40, 'b' * 40, True)
+        self.store.put_ancestry('b' * 40, 'a' * 40, False)
+        self.assertEqual(True, self.store.get_ancestry('a' * 40, 'b' * 40))
+        self.assertEqual(False, self.store.get_ancestry('b' * 40, 'a' * 40))
+
+    def test_graph(self):
+        self.assertEqual([], self.store.get_graph())
+        self.store.put_graph([('a' * 40, ()), ('b' * 40, ('a' * 40,))], ['b' * 40])
+        self.assertEqual([('a' * 40, ()), ('b' * 40, ('a' * 40,))], sorted(self.store.get_graph()))
+        self.assertEqual(['b' * 40], self.store.get_graph_tips())
+
+    def test_graph_tips_limited(self):
+        for i in range(0, subject._max_graph_tips + 5):
+            self.store.put_graph([], ['%040x' % i])
+        self.assertEqual(subject._max_graph_tips, len(self.store.get_graph_tips()))
+
+    def test_topo_order(self):
+        shas = ['a' * 40, 'b' * 40]
+        self.assertEqual(None, self.store.get_topo_order('b' * 40))
+        self.store.put_topo_order('b' * 40, shas)
+        self.assertEqual(shas, self.store.get_topo_order('b' * 40))
+
+    def test_other_thread(self):
+        self.store.put_ancestry('a' * 40, 'b' * 40, True)
+        results = []
+        def read():
+            results.append(self.store.get_ancestry('a' * 40, 'b' * 40))
+        t = threading.Thread(target=read)
+        t.start()
+        t.join()
+        self.assertEqual([True], results)
+
+    def test_unusable_database(self):
+        store = subject.CommitStore(os.path.join(self.scratch, 'missing', 'commits.sqlite'))
+        store.put_ancestry('a' * 40, 'b' * 40, True)
+        self.assertEqual(None, store.get_ancestry('a' * 40, 'b' * 40))
+        self.assertEqual({}, store.get_commits(['a' * 40]))
@@ -0,0 +1,26 @@
+import unittest
+
+import gaia_uplift.git as git
+import gaia_uplift.find_commits as subject
+from git_tests import TestWithRepository
+
+
+class GuessCommit(TestWithRepository):
+    def test_guess_commit(self):
+        commits = self.create_repo([{'A': '1'}, {'A': '2'}])
+        git.git_op(['checkout', '-b', 'other'], self.scratch)
+        other_commits = self.create_commits([{'A': '3'}])
+        def comment(text):
+            return {'text': text, 'creator': {'name': 'someone'}}
+        bugs = {
+            1: {'comments': [comment('master: %s' % commits[0]),
+                             comment('landed https://github.com/mozilla-b2g/gaia/commit/%s' % commits[0])]},
+            2: {'comments': [comment('master: %s' % other_commits[0]), comment('master: %s' % ('f' * 40))],
+                'attachments': [comment('master: %s' % commits[1])]},
+            3: {},
+        }
+        actual = dict([(x, subject.guess_commit(self.scratch, 'master', bugs[x])) for x in bugs.keys()])
+        self.assertEqual([commits[0]], actual[1].keys())
+        self.assertEqual(2, len(actual[1][commits[0]]))
+        self.assertEqual([commits[1]], actual[2].keys())
+        self.assertEqual({}, actual[3])
@@ -2,8 +2,11 @@ import unittest
 import tempfile
 import os
 import subprocess
+import time
 import shutil
 
+from mock import patch
+
 import gaia_uplift.git as subject
 
 class GitTestBase(unittest.TestCase):
@@ -12,7 +15,13 @@ class GitTestBase(unittest.TestCase):
 
     def tearDown(self):
         # TODO: Is it possible to only delete directory on a failed test?
+        subject.close_object_services(self.scratch)
+        subject.close_commit_stores()
         shutil.rmtree(self.scratch)
+        commit_db = os.path.join(os.path.dirname(self.scratch), '.%s.commits.sqlite' % os.path.basename(self.scratch))
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(commit_db + suffix):
+                os.unlink(commit_db + suffix)
 
 
 class RunCmd(GitTestBase):
@@ -164,6 +173,35 @@ class SimpleGitTests(TestWithRepository):
         self.assertTrue(subject.show(self.scratch).startswith(commits[-1]))
         self.assertTrue(subject.show(self.scratch, '2').startswith(commits[2]))
 
+    def test_get_rev_missing(self):
+        self.create_repo([{'A': 1}])
+        with self.assertRaises(subject.GitError):
+            subject.get_rev(self.scratch, 'not-a-ref')
+
+    def test_read_object(self):
+        commits = self.create_repo([{'A': 1}, {'A': 2}])
+        contents = subject.read_object(self.scratch, commits[1])
+        self.assertTrue(contents.startswith('tree '))
+        self.assertTrue('parent %s' % commits[0] in contents)
+        self.assertEqual('2', subject.read_object(self.scratch, '%s:A' % commits[1]))
+
+    def test_object_service_reused(self):
+        commits = self.create_repo([{'A': 1}])
+        service = subject.object_service(self.scratch)
+        self.assertEqual('commit', subject.git_object_type(self.scratch, commits[0]))
+        self.assertTrue(service is subject.object_service(self.scratch))
+        proc = service.procs['--batch-check']
+        subject.get_rev(self.scratch, commits[0][:7])
+        self.assertTrue(proc is service.procs['--batch-check'])
+
+    def test_object_service_restarts(self):
+        commits = self.create_repo([{'A': 1}])
+        service = subject.object_service(self.scratch)
+        self.assertEqual(commits[0], subject.get_rev(self.scratch))
+        service.procs['--batch-check'].kill()
+        service.procs['--batch-check'].wait()
+        self.assertEqual(commits[0], subject.get_rev(self.scratch))
+
     def test_valid_id(self):
         ids = ['abcdef1234567',
                'a'*40,
@@ -180,12 +218,6 @@ class SimpleGitTests(TestWithRepository):
         for invalid_id in ids:
             self.assertFalse(subject.valid_id(invalid_id))
 
-    def test__parse_branches(self):
-        cmd_out =  "  master\n"
-        cmd_out += "  v1.2\n"
-        cmd_out += "* v1.3\n"
-        self.assertEqual(['master', 'v1.2', 'v1.3'], subject._parse_branches(cmd_out))
-
     def test_commit_on_branch(self):
         repo_contents = [
             {'A': 1},
@@ -205,6 +237,88 @@ class SimpleGitTests(TestWithRepository):
         self.assertFalse(subject.commit_on_branch(self.scratch, branch_commits[1], 'master'))
         self.assertTrue(subject.commit_on_branch(self.scratch, branch_commits[1], 'newbranch'))
 
+    def test_commit_on_other_branch(self):
+        commits = self.create_repo([{'A': 1}, {'A': 2}])
+        subject.git_op(['checkout', '-b', 'other', commits[0]], self.scratch)
+        self.assertFalse(subject.commit_on_branch(self.scratch, commits[1], 'other'))
+        self.assertEqual(False, subject._ancestry[(commits[1], commits[0])])
+        self.assertFalse(subject.reachability_index(self.scratch).reachable.has_key('other'))
+        self.assertFalse(subject.commit_on_branch(self.scratch, commits[1], 'nonexistent'))
+        subject.git_op(['merge', '--ff-only', commits[1]], self.scratch)
+        self.assertTrue(subject.commit_on_branch(self.scratch, commits[1], 'other'))
+
+    def test_is_ancestor(self):
+        commits = self.create_repo([{'A': 1}, {'A': 2}])
+        self.assertTrue(subject.is_ancestor(self.scratch, commits[0], 'master'))
+        self.assertFalse(subject.is_ancestor(self.scratch, commits[1], '0'))
+        with patch('gaia_uplift.git.git_op') as git_op:
+            self.assertTrue(subject.is_ancestor(self.scratch, commits[0], commits[1]))
+            self.assertFalse(git_op.called)
+
+    def test_is_ancestor_git_failure(self):
+        commits = self.create_repo([{'A': 1}, {'A': 2}])
+        real_git_op = subject.git_op
+        def git_op(command, *args, **kwargs):
+            if command[0] == 'merge-base':
+                raise subject.GitError({'super_exc': subprocess.CalledProcessError(128, command, '')})
+            return real_git_op(command, *args, **kwargs)
+        # Test repositories share shas, so an earlier test may have asked
+        subject._ancestry.pop((commits[1], commits[0]), None)
+        with patch('gaia_uplift.git.git_op', side_effect=git_op):
+            with self.assertRaises(subject.GitError):
+                subject.is_ancestor(self.scratch, commits[1], commits[0])
+        self.assertFalse(subject._ancestry.has_key((commits[1], commits[0])))
+        self.assertEqual(None, subject.commit_store(self.scratch).get_ancestry(commits[1], commits[0]))
+        self.assertFalse(subject.is_ancestor(self.scratch, commits[1], commits[0]))
+
+    def test_reachability_index_incremental(self):
+        commits = self.create_repo([{'A': 1}, {'A': 2}])
+        index = subject.reachability_index(self.scratch)
+        self.assertTrue(index.contains(commits[1], 'master'))
+        self.assertEqual(2, len(index.shas))
+        subject.git_op(['checkout', '-b', 'other'], self.scratch)
+        new_commits = self.create_commits([{'A': 3}])
+        self.assertFalse(index.contains(new_commits[0], 'master'))
+        self.assertTrue(index.contains(new_commits[0], 'other'))
+        self.assertTrue(index.contains(commits[0], 'other'))
+        self.assertEqual(3, len(index.shas))
+        self.assertTrue(index is subject.reachability_index(self.scratch))
+
+    def test_reachability_index_stored(self):
+        commits = self.create_repo([{'A': 1}, {'A': 2}])
+        self.assertTrue(subject.reachability_index(self.scratch).contains(commits[0], 'master'))
+        del subject._reachability[os.path.abspath(self.scratch)]
+        # The next run reads the graph from the commit store
+        with patch('gaia_uplift.git.git_op', wraps=subject.git_op) as git_op:
+            index = subject.reachability_index(self.scratch)
+            self.assertTrue(index.contains(commits[0], 'master'))
+            self.assertFalse(git_op.called)
+        new_commits = self.create_commits([{'A': 3}])
+        with patch('gaia_uplift.git.git_op', wraps=subject.git_op) as git_op:
+            self.assertTrue(index.contains(new_commits[0], 'master'))
+            command = git_op.call_args[0][0]
+        # Only the new commit is read
+        self.assertEqual(['rev-list', '--parents', new_commits[0], '--not', commits[1]], command)
+        self.assertEqual(3, len(subject.commit_store(self.scratch).get_graph()))
+
+    def test_topo_positions_stored(self):
+        commits = self.create_repo([{'A': 1}, {'A': 2}])
+        self.assertEqual({commits[0]: 0, commits[1]: 1}, subject.topo_positions(self.scratch, 'master'))
+        subject._topo_positions.clear()
+        with patch('gaia_uplift.git.git_op') as git_op:
+            self.assertEqual({commits[0]: 0, commits[1]: 1}, subject.topo_positions(self.scratch, 'master'))
+            self.assertFalse(git_op.called)
+
+    def test_reachability_index_branch_moved_back(self):
+        commits = self.create_repo([{'A': 1}, {'A': 2}, {'A': 3}])
+        index = subject.reachability_index(self.scratch)
+        self.assertTrue(index.contains(commits[2], 'master'))
+        subject.git_op(['reset', '--hard', commits[0]], self.scratch)
+        self.assertFalse(index.contains(commits[2], 'master'))
+        self.assertFalse(index.contains(commits[1], 'master'))
+        self.assertTrue(index.contains(commits[0], 'master'))
+        self.assertFalse(index.contains(commits[0], 'nonexistent'))
+
     def test_git_object_type(self):
         commit = self.create_repo([{'A': '1'}])[0] 
         self.assertEqual('commit', subject.git_object_type(self.scratch, commit))
@@ -252,6 +366,34 @@ class SimpleGitTests(TestWithRepository):
         branch_commits = self.create_commits(branch_contents)
         self.assertEqual('newbranch', subject.current_branch(self.scratch))
 
+    def test_current_branch_detached(self):
+        self.create_repo([{'A': '1'}])
+        subject.checkout(self.scratch, 'HEAD', detach=True)
+        self.assertEqual(None, subject.current_branch(self.scratch))
+
+    def test_ref_snapshot(self):
+        commits = self.create_repo([{'A': '1'}])
+        subject.git_op(['branch', 'newbranch'], self.scratch)
+        refs = subject.ref_snapshot(self.scratch)
+        self.assertIs(refs, subject.ref_snapshot(self.scratch))
+        self.assertEqual(['master', 'newbranch'], refs.branches())
+        self.assertTrue(refs.has_branch('newbranch'))
+        self.assertFalse(refs.has_branch('missing'))
+        self.assertEqual(commits[0], refs.tip('newbranch'))
+        self.assertEqual(commits[0], refs.tip('refs/heads/master'))
+        self.assertEqual(None, refs.tip('missing'))
+        self.assertEqual('master', refs.current_branch())
+
+    def test_ref_snapshot_invalidated(self):
+        self.create_repo([{'A': '1'}])
+        refs = subject.ref_snapshot(self.scratch)
+        new_commits = self.create_commits([{'A': '2'}])
+        self.assertIsNot(refs, subject.ref_snapshot(self.scratch))
+        self.assertEqual(new_commits[0], subject.ref_snapshot(self.scratch).tip('master'))
+        refs = subject.ref_snapshot(self.scratch)
+        subject.get_rev(self.scratch)
+        self.assertIs(refs, subject.ref_snapshot(self.scratch))
+
     def test_checkout(self):
         contents = [{'A': '1'}]
         commits = self.create_repo(contents)
@@ -264,6 +406,19 @@ class SimpleGitTests(TestWithRepository):
         # There should be a check to see if the newbranch2 is actually tracking
         # master
 
+    def test_worktree(self):
+        commits = self.create_repo([{'A': '1'}])
+        subject.git_op(['branch', 'newbranch'], self.scratch)
+        new_commits = self.create_commits([{'A': '2'}])
+        path = subject.add_worktree(self.scratch, 'newbranch')
+        self.assertEqual('newbranch', subject.current_branch(path))
+        new_rev = subject.cherry_pick(path, new_commits[0], 'newbranch', 'master')
+        self.assertEqual(new_rev, subject.get_rev(self.scratch, 'newbranch'))
+        self.assertEqual('master', subject.current_branch(self.scratch))
+        subject.remove_worktree(self.scratch, path)
+        self.assertFalse(os.path.exists(path))
+        shutil.rmtree(subject._worktrees_dir(self.scratch))
+
     def test_merge_ff(self):
         contents = [{'A': '1'}]
         branch_contents = [{'A': '2'}]
@@ -335,6 +490,175 @@ class SimpleGitTests(TestWithRepository):
         self.assertTrue(subject.commit_on_branch(self.scratch, branch_commit, 'newbranch'))
         self.assertFalse(subject.commit_on_branch(self.scratch, branch_commit, 'master'))
 
+    def test_cherry_pick_already_uplifted(self):
+        commits = self.create_repo([{'A': '1'}])
+        subject.git_op(['branch', 'newbranch'], self.scratch)
+        master_commits = self.create_commits([{'B': '1'}])
+        subject.checkout(self.scratch, 'newbranch')
+        # Uplifted by hand, so the sha is different
+        branch_commits = self.create_commits([{'B': '1'}])
+        with self.assertRaises(subject.GitNoop):
+            subject.cherry_pick(self.scratch, master_commits[0], 'newbranch')
+        with self.assertRaises(subject.GitNoop):
+            subject.cherry_pick_objects(self.scratch, master_commits[0], 'newbranch')
+        self.assertEqual(branch_commits[0], subject.get_rev(self.scratch, 'newbranch'))
+
+    def test_patch_on_branch(self):
+        commits = self.create_repo([{'A': '1'}])
+        subject.checkout(self.scratch, branch_name='newbranch')
+        branch_commits = self.create_commits([{'A': '2'}])
+        subject.checkout(self.scratch, 'master')
+        master_commits = self.create_commits([{'B': '1'}, {'A': '3'}, {'C': '1'}])
+        self.assertEqual(None, subject.patch_on_branch(self.scratch, master_commits[0], 'newbranch'))
+        subject.checkout(self.scratch, 'newbranch')
+        picked = subject.cherry_pick(self.scratch, master_commits[0], 'newbranch')
+        self.assertEqual(picked, subject.patch_on_branch(self.scratch, master_commits[0], 'newbranch'))
+        # A conflict resolved by hand changes the patch, but leaves the -x line
+        with open(os.path.join(self.scratch, 'A'), 'w') as f:
+            f.write('2 and 3')
+        subject.git_op(['commit', '-a', '-m', 'commit-2\n\n(cherry picked from commit %s)' % master_commits[1]],
+                       self.scratch)
+        resolved = subject.get_rev(self.scratch)
+        self.assertEqual(resolved, subject.patch_on_branch(self.scratch, master_commits[1], 'newbranch'))
+        self.assertEqual(None, subject.patch_on_branch(self.scratch, master_commits[2], 'newbranch'))
+
+        # The index is saved with the tip it was built from
+        index = subject.patch_index(self.scratch)
+        del subject._patch_indexes[os.path.abspath(self.scratch)]
+        saved = subject.patch_index(self.scratch)._load('newbranch')
+        self.assertEqual(resolved, saved['tip'])
+        self.assertEqual(index.branches['newbranch'], saved)
+
+    def test_patch_on_branch_rename(self):
+        commits = self.create_repo([{'A': 'line\n' * 20}])
+        subject.git_op(['branch', 'newbranch'], self.scratch)
+        subject.git_op(['mv', 'A', 'B'], self.scratch)
+        subject.git_op(['commit', '-m', 'rename'], self.scratch)
+        renamed = subject.get_rev(self.scratch)
+        # The same rename made by hand on the branch, without a -x line
+        subject.checkout(self.scratch, 'newbranch')
+        subject.git_op(['mv', 'A', 'B'], self.scratch)
+        subject.git_op(['commit', '-m', 'rename by hand'], self.scratch)
+        by_hand = subject.get_rev(self.scratch)
+        subject.checkout(self.scratch, 'master')
+        self.assertEqual(by_hand, subject.patch_on_branch(self.scratch, renamed, 'newbranch'))
+
+    def test_cherry_pick_message(self):
+        sha = 'a' * 40
+        self.assertEqual('subject\n\n(cherry picked from commit %s)\n' % sha,
+                         subject.cherry_pick_message('subject\n', sha))
+        self.assertEqual('subject\n\nr=me\n\n(cherry picked from commit %s)\n' % sha,
+                         subject.cherry_pick_message('subject\n\nr=me', sha))
+        self.assertEqual('subject\n\nSigned-off-by: me\n(cherry picked from commit %s)\n' % sha,
+                         subject.cherry_pick_message('subject\n\nSigned-off-by: me\n', sha))
+
+    def test_cherry_pick_objects(self):
+        commits = self.create_repo([{'A': '1', 'B': '2'}])
+        subject.git_op(['branch', 'newbranch'], self.scratch)
+        new_master_commits = self.create_commits([{'A': '3'}])
+        branch_commit = subject.cherry_pick_objects(self.scratch, new_master_commits[0], 'newbranch')
+        self.assertEqual(branch_commit, subject.get_rev(self.scratch, 'newbranch'))
+        self.assertEqual([commits[0]], subject.find_parents(self.scratch, branch_commit))
+        self.assertEqual('3', subject.read_object(self.scratch, '%s:A' % branch_commit))
+        info = subject.commit_info(self.scratch, branch_commit)
+        self.assertEqual(subject.commit_info(self.scratch, new_master_commits[0]).author_date, info.author_date)
+        self.assertTrue(info.message.endswith('(cherry picked from commit %s)\n' % new_master_commits[0]))
+        self.assertEqual('master', subject.current_branch(self.scratch))
+        with self.assertRaises(subject.GitNoop):
+            subject.cherry_pick_objects(self.scratch, commits[0], 'newbranch')
+
+    def test_cherry_pick_objects_merge_commit(self):
+        commits = self.create_repo([{'A': '1', 'B': '2'}])
+        subject.git_op(['branch', 'newbranch'], self.scratch)
+        subject.checkout(self.scratch, branch_name='pr_branch', tracking='master')
+        pr_commits = self.create_commits([{'C': '3'}])
+        subject.checkout(self.scratch, 'master')
+        self.create_commits([{'A': '4'}])
+        subject.merge(self.scratch, 'pr_branch', no_ff=True)
+        merge_commit = subject.get_rev(self.scratch)
+        branch_commit = subject.cherry_pick_objects(self.scratch, merge_commit, 'newbranch')
+        self.assertEqual('3', subject.read_object(self.scratch, '%s:C' % branch_commit))
+        self.assertEqual('1', subject.read_object(self.scratch, '%s:A' % branch_commit))
+
+    def test_cherry_pick_objects_conflict(self):
+        commits = self.create_repo([{'A': '1'}])
+        subject.checkout(self.scratch, branch_name='newbranch')
+        branch_commits = self.create_commits([{'A': '2'}])
+        subject.checkout(self.scratch, 'master')
+        master_commits = self.create_commits([{'A': '3'}])
+        with self.assertRaises(subject.GitError):
+            subject.cherry_pick_objects(self.scratch, master_commits[0], 'newbranch')
+        self.assertEqual(branch_commits[0], subject.get_rev(self.scratch, 'newbranch'))
+
+    def test_cherry_pick_sequence(self):
+        commits = self.create_repo([{'A': '1'}])
+        subject.git_op(['branch', 'newbranch'], self.scratch)
+        master_commits = self.create_commits([{'B': '1'}, {'C': '1'}])
+        new_commits = subject.cherry_pick_sequence(self.scratch, master_commits, 'newbranch')
+        self.assertEqual(2, len(new_commits))
+        self.assertEqual(new_commits[1], subject.get_rev(self.scratch, 'newbranch'))
+        self.assertEqual([new_commits[0]], subject.find_parents(self.scratch, new_commits[1]))
+        self.assertEqual('1', subject.read_object(self.scratch, '%s:C' % new_commits[1]))
+
+    def test_cherry_pick_sequence_conflict(self):
+        commits = self.create_repo([{'A': '1'}])
+        subject.checkout(self.scratch, branch_name='newbranch')
+        branch_commits = self.create_commits([{'A': '2'}])
+        subject.checkout(self.scratch, 'master')
+        master_commits = self.create_commits([{'B': '1'}, {'A': '3'}])
+        with self.assertRaises(subject.GitError):
+            subject.cherry_pick_sequence(self.scratch, master_commits, 'newbranch')
+        self.assertEqual(branch_commits[0], subject.get_rev(self.scratch, 'newbranch'))
+
+    def test_maintain_repo(self):
+        commits = self.create_repo([{'A': '1'}, {'A': '2'}])
+        results = subject.maintain_repo(self.scratch)
+        self.assertEqual(['repack', 'commit-graph'], [x[0] for x in results])
+        self.assertTrue(all(x[2] for x in results))
+        objects = os.path.join(self.scratch, '.git', 'objects')
+        self.assertTrue(os.path.exists(os.path.join(objects, 'pack', 'multi-pack-index')))
+        self.assertTrue(os.path.exists(os.path.join(objects, 'info', 'commit-graphs', 'commit-graph-chain')))
+        self.assertEqual(commits[1], subject.get_rev(self.scratch, 'master'))
+
+    def test_start_maintenance(self):
+        self.create_repo([{'A': '1'}])
+        self.assertEqual(0, subject.start_maintenance(self.scratch).wait())
+        objects = os.path.join(self.scratch, '.git', 'objects')
+        self.assertTrue(os.path.exists(os.path.join(objects, 'info', 'commit-graphs', 'commit-graph-chain')))
+
+    def test_start_maintenance_once(self):
+        self.create_repo([{'A': '1'}])
+        with patch('gaia_uplift.git.maintenance_steps') as maintenance_steps, \
+             patch('subprocess.Popen') as popen:
+            maintenance_steps.return_value = [('gc', ['gc'])]
+            popen.return_value.poll.return_value = None
+            first = subject.start_maintenance(self.scratch)
+            self.assertIs(first, subject.start_maintenance(self.scratch))
+            self.assertEqual(1, popen.call_count)
+            popen.return_value.poll.return_value = 0
+            subject.start_maintenance(self.scratch)
+            self.assertEqual(2, popen.call_count)
+            subject.reap_maintenance()
+            self.assertFalse(popen.return_value.wait.called)
+        self.assertEqual({}, subject._maintenance_procs)
+
+    def test_reap_maintenance_does_not_wait(self):
+        running = subprocess.Popen(['sleep', '30'])
+        finished = subprocess.Popen(['true'])
+        finished.wait()
+        subject._maintenance_procs['running'] = (os.getpid(), running)
+        subject._maintenance_procs['finished'] = (os.getpid(), finished)
+        try:
+            start = time.time()
+            subject.reap_maintenance()
+            self.assertTrue(time.time() - start < 5)
+            self.assertEqual(None, running.poll())
+            self.assertEqual(['running'], subject._maintenance_procs.keys())
+        finally:
+            running.kill()
+            running.wait()
+            subject._maintenance_procs.clear()
+
     def test_a_before_b(self):
         contents = [{'A': '1'}, {'A': '2'}, {'A': '3'}]
         commits = self.create_repo(contents)
@@ -364,6 +688,44 @@ class SimpleGitTests(TestWithRepository):
             subject.a_before_b(self.scratch, 'master', cache, commits[2], commits[0])
         )        
 
+    def test_load_commit_metadata(self):
+        commits = self.create_repo([{'A': 1}, {'A': 2}, {'A': 3}])
+        names = [commits[0][:7], commits[2], '1']
+        metadata = subject.load_commit_metadata(self.scratch, names)
+        self.assertEqual(sorted(names), sorted(metadata.keys()))
+        self.assertEqual(commits[0], metadata[commits[0][:7]].sha)
+        self.assertEqual((), metadata[commits[0][:7]].parents)
+        self.assertEqual((commits[0],), metadata['1'].parents)
+        self.assertEqual(1000000002, metadata[commits[2]].commit_time)
+        self.assertEqual('1000000002 +0000', metadata[commits[2]].author_date)
+        self.assertEqual('commit-2', metadata[commits[2]].message.strip())
+        self.assertTrue(subject.commit_metadata[commits[1]] is subject.commit_info(self.scratch, '1'))
+
+    def test_commit_info_annotated_tag(self):
+        commits = self.create_repo([{'A': 1}, {'A': 2}])
+        subject.git_op(['tag', '-a', '-m', 'annotated', 'annotated', commits[0]], self.scratch)
+        self.assertNotEqual(commits[0], subject.get_rev(self.scratch, 'annotated'))
+        self.assertEqual(commits[0], subject.commit_info(self.scratch, 'annotated').sha)
+        metadata = subject.load_commit_metadata(self.scratch, ['annotated', '1'])
+        self.assertEqual(commits[0], metadata['annotated'].sha)
+        self.assertEqual(commits[1], metadata['1'].sha)
+
+    def test_commit_metadata_store(self):
+        commits = self.create_repo([{'A': '1'}, {'A': '2'}])
+        # Other tests create the same commits, forget what they found out
+        def forget():
+            for x in commits:
+                subject.commit_metadata.pop(x, None)
+            subject._ancestry.pop((commits[0], commits[1]), None)
+        forget()
+        expected = subject.load_commit_metadata(self.scratch, commits)
+        subject.is_ancestor(self.scratch, commits[0], commits[1])
+        forget()
+        with patch('gaia_uplift.git.git_op') as git_op:
+            self.assertEqual(expected, subject.load_commit_metadata(self.scratch, commits))
+            self.assertTrue(subject.is_ancestor(self.scratch, commits[0], commits[1]))
+            self.assertFalse(git_op.called)
+
     def test_sort_commits(self):
         contents = [{'A': x} for x in range(0,10)]
         commits = self.create_repo(contents)
@@ -378,6 +740,155 @@ class SimpleGitTests(TestWithRepository):
                          subject.sort_commits(self.scratch, shuffled_commits, 'master'))
 
 
+    def test_sort_commits_same_commit_time(self):
+        commits = self.create_repo([{'A': 1}])
+        env = {
+            'GIT_AUTHOR_DATE': '1000000000 +0000',
+            'GIT_COMMITTER_DATE': '1000000000 +0000'
+        }
+        for i in range(3):
+            subject.git_op(['commit', '--allow-empty', '-m', 'same-%d' % i], self.scratch, env=env)
+            commits.append(subject.get_rev(self.scratch))
+        self.assertEqual(commits,
+                         subject.sort_commits(self.scratch, list(reversed(commits)), 'master'))
+        self.assertEqual(commits[1] < commits[2],
+                         subject.a_before_b(self.scratch, 'master', {}, commits[1], commits[2]))
+
+    def test_sort_commits_off_branch(self):
+        commits = self.create_repo([{'A': x} for x in range(3)])
+        subject.git_op(['checkout', '-b', 'other', commits[0]], self.scratch)
+        other_commits = self.create_commits([{'B': 1}])
+        self.assertEqual(commits + other_commits,
+                         subject.sort_commits(self.scratch,
+                                              other_commits + commits + [commits[1]],
+                                              'master'))
+
+
+class CreateGaiaTests(TestWithRepository):
+    def setUp(self):
+        TestWithRepository.setUp(self)
+        self.parent = tempfile.mkdtemp(prefix='.scratch_', dir='.')
+        self.gaia = os.path.abspath(os.path.join(self.parent, 'gaia'))
+        self.url = os.path.abspath(self.scratch)
+
+    def tearDown(self):
+        subject.delete_gaia(self.gaia)
+        shutil.rmtree(self.parent)
+        TestWithRepository.tearDown(self)
+
+    def test_refresh(self):
+        commits = self.create_repo([{'A': '1'}])
+        for branch in ['v1.2', 'v1.3', 'v1.4']:
+            subject.git_op(['branch', branch], self.scratch)
+        master_commits = self.create_commits([{'A': '2'}])
+        subject.create_gaia(self.gaia, self.url)
+        self.assertEqual(commits[0], subject.get_rev(self.gaia, 'v1.3'))
+        marker = os.path.join(self.gaia, '.git', 'not-recloned')
+        open(marker, 'w').close()
+
+        # Leave the scratch copy in a mess, like an interrupted uplift would
+        subject.checkout(self.gaia, 'v1.3')
+        with open(os.path.join(self.gaia, 'A'), 'w') as f:
+            f.write('3')
+        subject.git_op(['commit', '-a', '-m', 'local'], self.gaia)
+        with self.assertRaises(subject.GitError):
+            subject.git_op(['cherry-pick', master_commits[0]], self.gaia)
+        open(os.path.join(self.gaia, 'untracked'), 'w').close()
+        subject.git_op(['checkout', 'v1.3'], self.scratch)
+        branch_commits = self.create_commits([{'B': '1'}])
+
+        subject.create_gaia(self.gaia, self.url)
+        self.assertTrue(os.path.exists(marker))
+        self.assertEqual('master', subject.current_branch(self.gaia))
+        self.assertEqual(master_commits[0], subject.get_rev(self.gaia, 'master'))
+        self.assertEqual(branch_commits[0], subject.get_rev(self.gaia, 'v1.3'))
+        self.assertEqual('', subject.git_op(['status', '--porcelain'], self.gaia))
+
+    def test_update(self):
+        commits = self.create_repo([{'A': '1'}])
+        for branch in ['v1.2', 'v1.3', 'v1.4']:
+            subject.git_op(['branch', branch], self.scratch)
+        subject.create_gaia(self.gaia, self.url)
+        subject.checkout(self.gaia, 'v1.2')
+        with open(os.path.join(self.gaia, 'A'), 'w') as f:
+            f.write('local')
+        subject.git_op(['commit', '-a', '-m', 'local'], self.gaia)
+        local = subject.get_rev(self.gaia)
+        subject.checkout(self.gaia, 'master')
+        master_commits = self.create_commits([{'A': '2'}])
+        subject.git_op(['checkout', 'v1.2'], self.scratch)
+        v12_commits = self.create_commits([{'B': '1'}])
+        subject.git_op(['checkout', 'v1.3'], self.scratch)
+        v13_commits = self.create_commits([{'C': '1'}])
+
+        not_updated = subject.update_gaia(self.gaia, self.url)
+        self.assertEqual(['v1.2'], not_updated.keys())
+        self.assertEqual(local, subject.get_rev(self.gaia, 'v1.2'))
+        self.assertEqual(master_commits[0], subject.get_rev(self.gaia, 'master'))
+        self.assertEqual(v13_commits[0], subject.get_rev(self.gaia, 'v1.3'))
+        self.assertEqual('master', subject.current_branch(self.gaia))
+        self.assertEqual('', subject.git_op(['status', '--porcelain'], self.gaia))
+
+        subject.update_gaia(self.gaia, self.url, checkout_branch='v1.3')
+        self.assertEqual('v1.3', subject.current_branch(self.gaia))
+        with open(os.path.join(self.gaia, 'C')) as f:
+            self.assertEqual('1', f.read())
+
+    def test_commit_store_in_mirror(self):
+        self.create_repo([{'A': '1'}])
+        for branch in ['v1.2', 'v1.3', 'v1.4']:
+            subject.git_op(['branch', branch], self.scratch)
+        subject.create_gaia(self.gaia, self.url)
+        self.assertEqual(os.path.join(subject._cache_dir(self.gaia), 'uplift-commits.sqlite'),
+                         subject.commit_store(self.gaia).filename)
+
+    def test_full(self):
+        commits = self.create_repo([{'A': '1'}])
+        for branch in ['v1.2', 'v1.3', 'v1.4']:
+            subject.git_op(['branch', branch], self.scratch)
+        subject.create_gaia(self.gaia, self.url)
+        marker = os.path.join(self.gaia, '.git', 'not-recloned')
+        open(marker, 'w').close()
+        subject.create_gaia(self.gaia, self.url, refresh=False)
+        self.assertFalse(os.path.exists(marker))
+        self.assertEqual(commits[0], subject.get_rev(self.gaia, 'v1.4'))
+
+    def test_share_objects(self):
+        commits = self.create_repo([{'A': '1'}])
+        for branch in ['v1.2', 'v1.3', 'v1.4']:
+            subject.git_op(['branch', branch], self.scratch)
+        with patch('gaia_uplift.git._share_objects', return_value=True):
+            subject.create_gaia(self.gaia, self.url)
+        cache_dir = subject._cache_dir(self.gaia)
+        with open(os.path.join(self.gaia, '.git', 'objects', 'info', 'alternates')) as f:
+            self.assertEqual(os.path.join(cache_dir, 'objects'), f.read().strip())
+        self.assertEqual('never', subject.git_op(['config', 'gc.pruneExpire'], cache_dir).strip())
+        self.assertEqual('0', subject.git_op(['config', 'gc.auto'], cache_dir).strip())
+        self.assertEqual(commits[0], subject.get_rev(self.gaia, 'v1.2'))
+
+    def test_partial_clone(self):
+        commits = self.create_repo([{'A': '1'}])
+        for branch in ['v1.2', 'v1.3', 'v1.4']:
+            subject.git_op(['branch', branch], self.scratch)
+        master_commits = self.create_commits([{'B': '1'}])
+        subject.git_op(['config', 'uploadpack.allowFilter', 'true'], self.scratch)
+        subject.git_op(['config', 'uploadpack.allowAnySHA1InWant', 'true'], self.scratch)
+        with patch('gaia_uplift.git._partial_clone_filter', return_value='blob:none'):
+            subject.create_gaia(self.gaia, 'file://%s' % self.url)
+        cache_dir = subject._cache_dir(self.gaia)
+        self.assertFalse(subject.is_partial_clone(self.scratch))
+        self.assertTrue(subject.is_partial_clone(cache_dir))
+        self.assertTrue(subject.is_partial_clone(self.gaia))
+        self.assertEqual('true', subject.git_op(['config', 'remote.origin.promisor'], self.gaia).strip())
+        self.assertFalse(subject.patch_index(self.gaia)._load('v1.2'))
+        # Blobs that a cherry-pick needs are fetched when it needs them
+        new_commit = subject.cherry_pick(self.gaia, master_commits[0], 'v1.2')
+        self.assertEqual('1', subject.read_object(self.gaia, '%s:B' % new_commit))
+        self.assertEqual({'format': subject._patch_index_format, 'tip': commits[0],
+                          'upstream': 'master', 'patch_ids': {}, 'picked': {}},
+                         subject.patch_index(self.gaia)._load('v1.2'))
+
+
 class GitPushTests(TestWithManyRepositories):
     def test_dry_run_clean(self):
         contents = [{'A': x} for x in range(5)] 
@@ -416,6 +927,45 @@ class GitPushTests(TestWithManyRepositories):
             subject.push(self.scratch[1], 'origin', ['master'])
 
 
+    def test_push_preview(self):
+        contents = [{'A': x} for x in range(5)] 
+        common_commits = self.create_repos(2, contents)
+        subject.git_op(['branch', 'other'], self.scratch[0])
+        subject.fetch(self.scratch[1])
+        subject.git_op(['branch', 'other', 'origin/other'], self.scratch[1])
+        new_commits = self.create_commits(1, [{'A': x} for x in range(5, 10)])
+        actual = subject.push_preview(self.scratch[1], 'origin', ['master', 'other'])
+        self.assertEqual({'url': os.path.abspath(self.scratch[0]),
+                          'branches': {'master': (common_commits[-1], new_commits[-1])}},
+                         actual)
+
+    def test_push_preview_not_fast_forward(self):
+        contents = [{'A': x} for x in range(5)] 
+        common_commits = self.create_repos(2, contents)
+        subject.git_op(['reset', '--hard', common_commits[-2]], self.scratch[1])
+        self.create_commits(1, [{'A': 10}])
+        with self.assertRaises(subject.PushFailure) as cm:
+            subject.push_preview(self.scratch[1], 'origin', ['master'])
+        self.assertEqual(['master'], cm.exception.rejected.keys())
+
+    def test_push_rejected_is_atomic(self):
+        contents = [{'A': x} for x in range(5)] 
+        common_commits = self.create_repos(2, contents)
+        subject.git_op(['branch', 'other'], self.scratch[0])
+        subject.checkout(self.scratch[0], branch_name='notmaster')
+        subject.fetch(self.scratch[1])
+        subject.git_op(['branch', 'other', 'origin/other'], self.scratch[1])
+        subject.git_op(['branch', '-f', 'other', common_commits[-2]], self.scratch[1])
+        subject.git_op(['reset', '--hard', common_commits[-2]], self.scratch[1])
+        self.create_commits(1, [{'A': 10}])
+        subject.git_op(['branch', '-f', 'other', 'master'], self.scratch[1])
+        subject.git_op(['reset', '--hard', common_commits[-1]], self.scratch[1])
+        new_commits = self.create_commits(1, [{'A': 11}])
+        with self.assertRaises(subject.PushFailure) as cm:
+            subject.push(self.scratch[1], 'origin', ['master', 'other'], dry_run=False)
+        self.assertEqual(['other'], cm.exception.rejected.keys())
+        self.assertEqual(common_commits[-1], subject.get_rev(self.scratch[0], 'master'))
+
     def test_for_real_clean(self):
         contents = [{'A': x} for x in range(5)] 
         common_commits = self.create_repos(2, contents)
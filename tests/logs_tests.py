@@ -0,0 +1,112 @@
+import unittest
+import tempfile
+import shutil
+import os
+import gzip
+import json
+
+import gaia_uplift.logs as subject
+
+
+class JSONLinesLogTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp(prefix='.scratch_', dir='.')
+        self.filename = os.path.join(self.scratch, 'test.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch)
+
+    def read_records(self, filename):
+        with open(filename) as f:
+            return [json.loads(x) for x in f.read().splitlines()]
+
+    def test_json_lines(self):
+        log = subject.JSONLinesLog(self.filename)
+        log.write({'a': 1})
+        log.write({'b': 'two'})
+        log.flush()
+        records = self.read_records(self.filename)
+        self.assertEqual([1, 'two'], [records[0]['a'], records[1]['b']])
+        self.assertTrue(records[0].has_key('time'))
+        log.close()
+
+    def test_binary_output(self):
+        log = subject.JSONLinesLog(self.filename)
+        log.write({'stdout': '\xff\xfe'})
+        log.close()
+        self.assertEqual(1, len(self.read_records(self.filename)))
+
+    def test_cap_truncate(self):
+        log = subject.JSONLinesLog(self.filename, output_cap=4, large_output='truncate')
+        self.assertEqual('abcd', log.cap('abcd'))
+        self.assertEqual(None, log.cap(None))
+        self.assertEqual({'truncated': 'abcd', 'bytes': 6}, log.cap('abcdef'))
+
+    def test_cap_hash(self):
+        log = subject.JSONLinesLog(self.filename, output_cap=4, large_output='hash')
+        self.assertEqual({'sha1': '1f8ac10f23c5b5bc1167bda84b833e5c057a77d2', 'bytes': 6},
+                         log.cap('abcdef'))
+
+    def test_rotate_on_size(self):
+        log = subject.JSONLinesLog(self.filename, max_bytes=100, backups=2)
+        for i in range(0, 3):
+            log.write({'data': 'x' * 100, 'i': i})
+            log.flush()
+        log.close()
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertFalse(os.path.exists(self.filename + '.3.gz'))
+        f = gzip.open(self.filename + '.1.gz')
+        try:
+            self.assertEqual(2, json.loads(f.read())['i'])
+        finally:
+            f.close()
+        self.assertTrue(os.path.exists(self.filename + '.2.gz'))
+
+    def test_rotate_on_age(self):
+        with open(self.filename, 'w') as f:
+            f.write(json.dumps({'time': 0}) + '\n')
+        log = subject.JSONLinesLog(self.filename, max_age=60)
+        log.write({'a': 1})
+        log.close()
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertTrue(os.path.exists(self.filename + '.1.gz'))
+
+    def test_forked_writers(self):
+        log = subject.JSONLinesLog(self.filename, max_bytes=2000, backups=100)
+        log.write({'parent': -1})
+        log.flush()
+        children = []
+        for child in range(0, 4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    for i in range(0, 50):
+                        log.write({'child': child, 'i': i, 'data': 'x' * 20})
+                finally:
+                    os._exit(0)
+            children.append(pid)
+        for i in range(0, 50):
+            log.write({'parent': i})
+        for pid in children:
+            os.waitpid(pid, 0)
+        log.close()
+        lines = []
+        for name in os.listdir(self.scratch):
+            path = os.path.join(self.scratch, name)
+            if name.endswith('.gz'):
+                f = gzip.open(path)
+                try:
+                    lines.extend(f.read().splitlines())
+                finally:
+                    f.close()
+            elif name == 'test.log':
+                with open(path) as f:
+                    lines.extend(f.read().splitlines())
+        records = [json.loads(x) for x in lines]
+        self.assertEqual(251, len(records))
+        for child in range(0, 4):
+            self.assertEqual(range(0, 50), sorted(x['i'] for x in records if x.get('child') == child))
+
+    def test_get_log_shared(self):
+        self.assertIs(subject.get_log(self.filename), subject.get_log(os.path.join(self.scratch, '.', 'test.log')))
+        subject._logs.pop(os.path.abspath(self.filename))
@@ -0,0 +1,45 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from mock import patch
+
+import gaia_uplift.git as git
+import gaia_uplift.merge_hd as subject
+from git_tests import TestWithRepository
+
+
+class Merge(TestWithRepository):
+    def setUp(self):
+        TestWithRepository.setUp(self)
+        self.parent = tempfile.mkdtemp(prefix='.scratch_', dir='.')
+        self.gaia = os.path.abspath(os.path.join(self.parent, 'gaia'))
+        self.url = os.path.abspath(self.scratch)
+
+    def tearDown(self):
+        git.delete_gaia(self.gaia)
+        shutil.rmtree(self.parent)
+        TestWithRepository.tearDown(self)
+
+    def test_unpushed_commits_are_dropped(self):
+        commits = self.create_repo([{'A': '1'}])
+        for branch in ['v1.2', 'v1.3', 'v1.4', 'hd']:
+            git.git_op(['branch', branch], self.scratch)
+        git.create_gaia(self.gaia, self.url)
+        git.recreate_branch(self.gaia, 'hd')
+        # Left behind by an uplift whose push was declined
+        with open(os.path.join(self.gaia, 'B'), 'w') as f:
+            f.write('local')
+        git.git_op(['add', 'B'], self.gaia)
+        git.git_op(['commit', '-m', 'unpushed'], self.gaia)
+        unpushed = git.get_rev(self.gaia, 'hd')
+        master_commits = self.create_commits([{'A': '2'}])
+
+        with patch('gaia_uplift.util.ask_yn') as ask_yn:
+            ask_yn.return_value = False
+            subject.merge(self.gaia, self.url, 'hd', 'master')
+        self.assertEqual('hd', git.current_branch(self.gaia))
+        self.assertEqual(master_commits[0], git.get_rev(self.gaia, 'hd'))
+        self.assertFalse(git.is_ancestor(self.gaia, unpushed, 'hd'))
+        self.assertFalse(os.path.exists(os.path.join(self.gaia, 'B')))
@@ -24,6 +24,40 @@ class TrimWords(unittest.TestCase):
         self.assertEqual(expected, actual)
 
 
+class DisplayPrediction(unittest.TestCase):
+    def test_table(self):
+        prediction = {
+            '123456': {
+                'commits': ['a' * 40, 'b' * 40],
+                'needed_on': ['v1', 'v2'],
+                'summary': 'Predicted',
+                'prediction': {
+                    'a' * 40: {'v1': 'clean', 'v2': 'present'},
+                    'b' * 40: {'v1': 'conflict', 'v2': 'invalid'},
+                }
+            },
+        }
+        with patch('gaia_uplift.configuration.read_value') as read_value:
+            read_value.return_value = ['v1', 'v2']
+            table = subject.display_prediction(prediction)
+        self.assertEqual(['Bug', 'master commit', 'v1 commit', 'v2 commit', 'Summary'],
+                         table.field_names)
+        rows = table._rows
+        self.assertEqual(1, len(rows))
+        self.assertEqual(['123456', 'aaaaaaa\nbbbbbbb', 'clean\nCONFLICT', '+++\nINVALID',
+                          'Predicted'], rows[0])
+        self.assertIn('CONFLICT', table.get_string())
+
+    def test_no_prediction(self):
+        prediction = {
+            '123456': {'commits': ['a' * 40], 'needed_on': ['v1'], 'summary': 'Nothing'}
+        }
+        with patch('gaia_uplift.configuration.read_value') as read_value:
+            read_value.return_value = ['v1']
+            table = subject.display_prediction(prediction)
+        self.assertEqual(['123456', 'aaaaaaa', '---', 'Nothing'], table._rows[0])
+
+
 class ClassifyGBU(unittest.TestCase):
     def test_good(self):
         report = {
@@ -4,12 +4,15 @@ import json
 from mock import patch
 import tempfile
 import copy
+import shutil
 
 import gaia_uplift.git as git
 import gaia_uplift.bzapi as bzapi
 import gaia_uplift.uplift as subject
 import gaia_uplift.configuration as c
 
+from git_tests import TestWithRepository
+
 class BugSkipping(unittest.TestCase):
 
     def setUp(self):
@@ -60,6 +63,20 @@ class FindBugsTest(unittest.TestCase):
             parse.assert_called_once_with('snow_storm')
             search.assert_called_once_with('my_butt')
             
+    def test_find_bugs_with_fields(self):
+        with patch('gaia_uplift.bzapi.search') as search, \
+             patch('gaia_uplift.bzapi.parse_bugzilla_query') as parse, \
+             patch('gaia_uplift.uplift.is_skipable') as is_skipable:
+
+            search.return_value = [{'id': 123456, 'summary': 'hi'}]
+            parse.return_value = ['query1', 'query2']
+            is_skipable.return_value = False
+
+            actual = subject.find_bugs(['snow_storm'], include_fields='id,summary')
+            self.assertEqual([{'id': 123456, 'summary': 'hi'}], actual)
+            search.assert_called_with('query2', 'id,summary')
+            is_skipable.assert_called_once_with(123456)
+
     def test_find_bugs_only_skipable(self):
         with patch('gaia_uplift.bzapi.search') as search, \
              patch('gaia_uplift.bzapi.parse_bugzilla_query') as parse, \
@@ -147,54 +164,245 @@ class UpliftCommit(unittest.TestCase):
             }
             self.assertEqual(expected, actual)
 
+class CommitStatuses(unittest.TestCase):
+    def test_commit_statuses(self):
+        needed_on = {'a': ['v1', 'v2'], 'b': ['v2']}
+        branch_results = {
+            'v1': {'a': 'a1'},
+            'v2': {'a': None, 'b': 'b2'}
+        }
+        expected = {
+            'a': {'success': {'v1': 'a1'}, 'failure': ['v2']},
+            'b': {'success': {'v2': 'b2'}, 'failure': []}
+        }
+        self.assertEqual(expected, subject.commit_statuses(['a', 'b'], needed_on, branch_results))
+
+
+class UpliftParallel(TestWithRepository):
+    def test_uplift_parallel(self):
+        commits = self.create_repo([{'A': '0'}])
+        git.git_op(['branch', 'v1'], self.scratch)
+        git.git_op(['branch', 'v2'], self.scratch)
+        git.checkout(self.scratch, 'v2')
+        self.create_commits([{'A': 'v2 only'}])
+        git.checkout(self.scratch, 'master')
+        master_commits = self.create_commits([{'B': '1'}, {'C': '1'}, {'A': '3'}])
+        needed_on = {
+            master_commits[0]: ['v1', 'v2'],
+            master_commits[1]: ['v1'],
+            master_commits[2]: ['v1', 'v2'],
+        }
+        actual = subject.uplift_parallel(self.scratch, master_commits, needed_on)
+        self.assertEqual([], actual[master_commits[0]]['failure'])
+        self.assertEqual(['v2'], actual[master_commits[2]]['failure'])
+        self.assertEqual(['v1'], actual[master_commits[2]]['success'].keys())
+        self.assertEqual(actual[master_commits[2]]['success']['v1'], git.get_rev(self.scratch, 'v1'))
+        self.assertEqual(actual[master_commits[0]]['success']['v2'], git.get_rev(self.scratch, 'v2'))
+        self.assertEqual('master', git.current_branch(self.scratch))
+        self.assertFalse(os.path.exists(os.path.join(git._worktrees_dir(self.scratch), 'v1')))
+        shutil.rmtree(git._worktrees_dir(self.scratch))
+
+    def test_uplift_parallel_in_memory(self):
+        commits = self.create_repo([{'A': '0'}])
+        git.git_op(['branch', 'v1'], self.scratch)
+        git.git_op(['branch', 'v2'], self.scratch)
+        master_commits = self.create_commits([{'B': '1'}, {'C': '1'}])
+        needed_on = {
+            master_commits[0]: ['v1', 'v2'],
+            master_commits[1]: ['v1'],
+        }
+        git.ref_snapshot(self.scratch)
+        actual = subject.uplift_parallel(self.scratch, master_commits, needed_on, in_memory=True)
+        self.assertEqual(actual[master_commits[1]]['success']['v1'],
+                         git.ref_snapshot(self.scratch).tip('v1'))
+        self.assertEqual(actual[master_commits[1]]['success']['v1'], git.get_rev(self.scratch, 'v1'))
+        self.assertEqual(actual[master_commits[0]]['success']['v2'], git.get_rev(self.scratch, 'v2'))
+        self.assertFalse(os.path.exists(git._worktrees_dir(self.scratch)))
+
+    def test_uplift_branch_batch(self):
+        commits = self.create_repo([{'A': '0'}])
+        git.git_op(['branch', 'v1'], self.scratch)
+        git.checkout(self.scratch, 'v1')
+        self.create_commits([{'A': 'v1 only'}])
+        git.checkout(self.scratch, 'master')
+        master_commits = self.create_commits([{'B': '1'}, {'A': '1'}, {'C': '1'}, {'D': '1'}])
+        actual = subject.uplift_branch_batch(self.scratch, 'v1', master_commits + [commits[0]])
+        self.assertEqual(None, actual[master_commits[1]])
+        self.assertEqual(commits[0], actual[commits[0]])
+        self.assertEqual(actual[master_commits[3]], git.get_rev(self.scratch, 'v1'))
+        self.assertEqual([actual[master_commits[2]]], git.find_parents(self.scratch, actual[master_commits[3]]))
+        self.assertTrue(git.commit_on_branch(self.scratch, actual[master_commits[0]], 'v1'))
+
+    def test_uplift_branch_batch_m2_merge(self):
+        commits = self.create_repo([{'A': '0'}])
+        git.git_op(['branch', 'v1'], self.scratch)
+        git.git_op(['branch', 'feature'], self.scratch)
+        master_commits = self.create_commits([{'B': '1'}])
+        git.checkout(self.scratch, 'feature')
+        self.create_commits([{'C': '1'}])
+        git.git_op(['merge', '--no-ff', '-m', 'merge master', 'master'], self.scratch)
+        merge = git.get_rev(self.scratch)
+        git.checkout(self.scratch, 'master')
+        git.merge(self.scratch, 'feature', ff_only=True)
+        plain = self.create_commits([{'D': '1'}])[0]
+        real_master_number = git.determine_cherry_pick_master_number
+        def master_number(repo_dir, commit, upstream):
+            # Picking the merge against its second parent brings in just C
+            if commit == merge:
+                return '-m2'
+            return real_master_number(repo_dir, commit, upstream)
+        with patch('gaia_uplift.git.determine_cherry_pick_master_number') as determine:
+            determine.side_effect = master_number
+            actual = subject.uplift_branch_batch(self.scratch, 'v1', [merge, plain])
+        self.assertNotEqual(None, actual[merge])
+        self.assertNotEqual(None, actual[plain])
+        self.assertEqual(actual[plain], git.get_rev(self.scratch, 'v1'))
+
+    def test_shares_run(self):
+        self.assertTrue(subject._shares_run(None, None))
+        self.assertTrue(subject._shares_run('-m1', None))
+        self.assertTrue(subject._shares_run(None, '-m1'))
+        self.assertTrue(subject._shares_run('-m2', '-m2'))
+        self.assertFalse(subject._shares_run('-m2', None))
+        self.assertFalse(subject._shares_run(None, '-m2'))
+        self.assertFalse(subject._shares_run('-m1', '-m2'))
+
+
+class Predict(TestWithRepository):
+    def test_predict_branch(self):
+        commits = self.create_repo([{'A': '0'}])
+        git.git_op(['branch', 'v1'], self.scratch)
+        git.checkout(self.scratch, 'v1')
+        self.create_commits([{'A': 'v1 only'}])
+        git.checkout(self.scratch, 'master')
+        master_commits = self.create_commits([{'B': '1'}, {'A': '2'}, {'B': '3'}])
+        git.git_op(['checkout', '-b', 'other'], self.scratch)
+        other_commits = self.create_commits([{'C': '1'}])
+        git.checkout(self.scratch, 'master')
+        v1_tip = git.get_rev(self.scratch, 'v1')
+        actual = subject.predict_branch(self.scratch, 'v1', commits + master_commits + other_commits)
+        expected = {
+            commits[0]: 'present',
+            master_commits[0]: 'clean',
+            master_commits[1]: 'conflict',
+            master_commits[2]: 'clean',
+            other_commits[0]: 'invalid'
+        }
+        self.assertEqual(expected, actual)
+        self.assertEqual(v1_tip, git.get_rev(self.scratch, 'v1'))
+        self.assertEqual('master', git.current_branch(self.scratch))
+
+    def test_predict_branch_empty_pick(self):
+        self.create_repo([{'A': '0', 'B': '0'}])
+        git.git_op(['branch', 'v1'], self.scratch)
+        git.checkout(self.scratch, 'v1')
+        # v1 has the change to A as part of a bigger commit, so the patch-ids
+        # differ but picking the master commit changes nothing
+        self.create_commits([{'A': '1', 'B': 'v1 only'}])
+        git.checkout(self.scratch, 'master')
+        master_commits = self.create_commits([{'A': '1'}])
+        actual = subject.predict_branch(self.scratch, 'v1', master_commits)
+        self.assertEqual({master_commits[0]: 'present'}, actual)
+
+    def test_predict(self):
+        commits = self.create_repo([{'A': '0'}])
+        git.git_op(['branch', 'v1'], self.scratch)
+        git.git_op(['branch', 'v2'], self.scratch)
+        git.checkout(self.scratch, 'v1')
+        self.create_commits([{'A': 'v1 only'}])
+        git.checkout(self.scratch, 'master')
+        master_commits = self.create_commits([{'B': '1'}, {'A': '2'}])
+        requirements = {
+            '123': {'commits': [master_commits[0]], 'needed_on': ['v1', 'v2'],
+                    'summary': 'clean everywhere'},
+            '456': {'commits': [master_commits[1]], 'needed_on': ['v1', 'v2'],
+                    'summary': 'conflicts on v1'},
+            '789': {'commits': [commits[0]], 'needed_on': ['v1'],
+                    'summary': 'already there'},
+            '999': {'needed_on': ['v1'], 'summary': 'no commits'},
+        }
+        v1_tip = git.get_rev(self.scratch, 'v1')
+        with patch('gaia_uplift.git.create_gaia') as create_gaia:
+            actual = subject.predict(self.scratch, 'url', requirements)
+            create_gaia.assert_called_once_with(self.scratch, 'url')
+        self.assertEqual(['123', '456', '789'], sorted(actual.keys()))
+        self.assertEqual({master_commits[0]: {'v1': 'clean', 'v2': 'clean'}},
+                         actual['123']['prediction'])
+        self.assertEqual({master_commits[1]: {'v1': 'conflict', 'v2': 'clean'}},
+                         actual['456']['prediction'])
+        self.assertEqual({commits[0]: {'v1': 'present'}}, actual['789']['prediction'])
+        self.assertFalse(requirements['123'].has_key('prediction'))
+        self.assertEqual(v1_tip, git.get_rev(self.scratch, 'v1'))
+
+
 class Push(unittest.TestCase):
     def test_success(self):
         with patch('gaia_uplift.git.push') as push, \
+             patch('gaia_uplift.git.push_preview') as push_preview, \
              patch('gaia_uplift.util.ask_yn') as ask_yn:
             ask_yn.return_value = True
             expected = {'url': None,
                         'branches': { 'master': ("a"*40, "b"*40) }
                        }
             
+            push_preview.return_value = expected
             push.return_value = expected
             actual = subject.push(None)
             self.assertEqual(expected, actual)
+            self.assertEqual(1, push.call_count)
 
     def test_no_push(self):
         with patch('gaia_uplift.git.push') as push, \
+             patch('gaia_uplift.git.push_preview') as push_preview, \
              patch('gaia_uplift.util.ask_yn') as ask_yn:
 
             preview = {'url': None,
                         'branches': { 'master': ("a"*40, "b"*40) }
             }
-            push.return_value = preview
+            push_preview.return_value = preview
             ask_yn.return_value = False
             self.assertEqual(None, subject.push(None))
+            self.assertFalse(push.called)
 
     def test_abject_failure(self):
         with patch('gaia_uplift.git.push') as push, \
+             patch('gaia_uplift.git.push_preview') as push_preview, \
              patch('gaia_uplift.util.ask_yn') as ask_yn:
 
-            preview = {'url': None,
-                       'branches': {'master': ("a"*40, "b"*40) }
-            }
-            ask_yn.return_value = False
+            ask_yn.return_value = True
+            push_preview.return_value = {'url': None, 'branches': {}}
             push.side_effect = git.PushFailure
             with self.assertRaises(git.PushFailure):
                 subject.push(None)
+            self.assertEqual(5, push.call_count)
 
     def test_recovery(self):
         with patch('gaia_uplift.git.push') as push, \
+             patch('gaia_uplift.git.push_preview') as push_preview, \
              patch('gaia_uplift.util.ask_yn') as ask_yn:
             ask_yn.return_value = True
             expected = {'url': None,
                         'branches': { 'master': ("a"*40, "b"*40) }
                        }
             
-            push.side_effect = [expected, git.PushFailure, expected]
+            push_preview.return_value = expected
+            push.side_effect = [git.PushFailure, expected]
             actual = subject.push(None)
             self.assertEqual(expected, actual)
 
+    def test_rejected(self):
+        with patch('gaia_uplift.git.push') as push, \
+             patch('gaia_uplift.git.push_preview') as push_preview, \
+             patch('gaia_uplift.git.fetch') as fetch, \
+             patch('gaia_uplift.util.ask_yn') as ask_yn:
+            ask_yn.return_value = True
+            push_preview.return_value = {'url': None, 'branches': {}}
+            push.side_effect = git.PushFailure('rejected', rejected={'master': '[rejected] (fetch first)'})
+            with self.assertRaises(git.PushFailure):
+                subject.push(None)
+            self.assertEqual(1, push.call_count)
+            fetch.assert_called_once_with(None, 'origin')
+
 class BuildUpliftRequirements(unittest.TestCase):
     def setUp(self):
         self.old_config = c.json_file
@@ -208,11 +416,8 @@ class BuildUpliftRequirements(unittest.TestCase):
         old_rf = subject.requirements_file
         subject.requirements_file = os.devnull
         with patch('gaia_uplift.uplift.find_bugs') as find_bugs, \
-             patch('gaia_uplift.uplift.is_skipable') as is_skipable, \
-             patch('gaia_uplift.bzapi.fetch_complete_bug') as fetch_bug, \
              patch('gaia_uplift.util.ask_yn') as ask_yn:
-            # This is basically a directory which we can use for the fake
-            # bug data fetching
+            # This is basically a directory of what the fake searches find
             bug_data = {
                 '1': {
                     'v1-status': 'fixed',
@@ -242,14 +447,12 @@ class BuildUpliftRequirements(unittest.TestCase):
                     'attachments': [{'flags': [{'name': 'approval-v3','status': '-'}]}]
                 },
             }
-            def fetch_bugs_gen(x):
-                return bug_data[x]
+            for bug_id in bug_data.keys():
+                bug_data[bug_id]['id'] = bug_id
 
             # Fake returns
             ask_yn.return_value = False
-            is_skipable.return_value = False
-            find_bugs.return_value = bug_data.keys()
-            fetch_bug.side_effect = fetch_bugs_gen
+            find_bugs.return_value = bug_data.values()
             
             expected = {
                 '1': {
@@ -271,6 +474,8 @@ class BuildUpliftRequirements(unittest.TestCase):
 
             actual = subject.build_uplift_requirements(None)
             self.assertEqual(expected, actual)
+            self.assertEqual('attachments,blocking,id,summary,v1-status,v2-status,v3-status',
+                             find_bugs.call_args[1]['include_fields'])
         subject.requirements_file = old_rf
 
 
@@ -353,6 +558,43 @@ class Uplift(unittest.TestCase):
             actual = subject.uplift(None, None, requirements)
             self.assertEqual(expected, actual)        
 
+    def test_parallel(self):
+        with patch('gaia_uplift.uplift.order_commits') as order_commits, \
+             patch('gaia_uplift.uplift.uplift_parallel') as uplift_parallel, \
+             patch('gaia_uplift.git.sort_commits') as sort_commits, \
+             patch('gaia_uplift.git.create_gaia') as create_gaia:
+
+            uplift_outcome = {
+                'success': {'v3': '321dcba'},
+                'failure': []
+            }
+
+            requirements = {
+                '1': {
+                    'needed_on': [u'v3'],
+                    'already_fixed_on': [],
+                    'summary': "success",
+                    'commits': ["abcd123"]
+                }
+            }
+
+            expected = copy.deepcopy(requirements)
+            expected['1']['uplift_status'] = {
+                'abcd123': uplift_outcome
+            }
+            expected['1']['flags_to_set'] = {
+                'v3-status': 'fixed'
+            }
+
+            uplift_parallel.return_value = {'abcd123': uplift_outcome}
+            order_commits.return_value = ['abcd123']
+            sort_commits.return_value = ['abcd123']
+
+            actual = subject.uplift(None, None, requirements, parallel=True)
+            self.assertEqual(expected, actual)
+            uplift_parallel.assert_called_once_with(None, ['abcd123'], {'abcd123': [u'v3']},
+                                                    in_memory=False, batch=False)
+
     def test_noop(self):
         with patch('gaia_uplift.uplift.order_commits') as order_commits, \
              patch('gaia_uplift.uplift.uplift_commit') as uplift_commit, \